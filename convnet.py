@@ -5,7 +5,7 @@ A Theano-based program for training and running simple neural
 networks.
 
 Supports several layer types (fully connected, convolutional, max
-pooling, softmax), and activation functions (sigmoid, tanh, and
+pooling, batch normalization, softmax), and activation functions (sigmoid, tanh, and
 rectified linear units, with more easily added).
 
 This program is revised from Michael Nielsen's ebook 
@@ -21,6 +21,12 @@ from Chris Olah (http://colah.github.io).
 # Standard library
 import six.moves.cPickle as pickle
 import gzip
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from time import time
 
 # Third-party libraries
 import numpy as np
@@ -28,15 +34,21 @@ import scipy
 import theano
 import theano.tensor as T
 from theano.tensor.nnet import conv2d
+from theano.tensor.nnet import conv as legacy_conv
+from theano.tensor.nnet.corr import CorrMM
+from theano.tensor import fft
 from theano.tensor.nnet import softmax
-from theano.tensor import shared_randomstreams
+from theano.sandbox.rng_mrg import MRG_RandomStreams
 from theano.tensor.signal import pool
+from theano.ifelse import ifelse
 
 # Activation functions for neurons
 def linear(z): return z
 def ReLU(z): return T.maximum(0.0, z)
 from theano.tensor.nnet import sigmoid
 from theano.tensor import tanh
+# by name, for exported models
+ACTIVATIONS = {'linear': linear, 'ReLU': ReLU, 'sigmoid': sigmoid, 'tanh': tanh}
 
 
 #### Constants
@@ -52,18 +64,115 @@ else:
         "the GPU flag to True."
 
 
+#### Precision policy
+# dtype of the datasets placed in shared variables by `shared`; the
+# weights, activations and optimizer state use theano.config.floatX
+STORAGE_DTYPE = theano.config.floatX
+
+def set_precision(policy):
+    """Set the precision policy of the networks and data created
+    afterwards.  With 'float64' or 'float32' the datasets, weights,
+    activations, dropout masks and optimizer state are all of that
+    dtype.  With 'float16' the datasets are stored in float16, halving
+    their memory, and each mini-batch is cast to float32, in which the
+    weights, optimizer state and all arithmetic stay: Theano's CPU ops
+    do not compute in float16.
+
+    """
+    global STORAGE_DTYPE
+    if policy not in ('float64', 'float32', 'float16'):
+        raise ValueError("Unknown precision policy {0}.".format(policy))
+    theano.config.floatX = 'float64' if policy == 'float64' else 'float32'
+    STORAGE_DTYPE = policy
+
+
+#### Execution configuration
+def set_threads(num_threads, openmp=True, cpus=None):
+    """Configure CPU execution for the networks compiled afterwards: use
+    `num_threads` intra-op threads for BLAS and OpenMP, let Theano's C
+    implementations of the conv, pool and elemwise ops run with OpenMP
+    if `openmp` is true, and pin the calling thread and the threads it
+    starts afterwards to the core ids in `cpus`.
+
+    BLAS and OpenMP read the environment only when they are loaded,
+    which importing this module has already done for numpy's BLAS, so
+    its thread pool is resized through threadpoolctl if installed, and
+    otherwise left as it is with a warning.  Likewise pinning applies
+    only to the calling thread and the threads started after it: the
+    BLAS threads already running stay where they are.  To control both
+    reliably, set the variables in the environment of a fresh process
+    and start it under `taskset`, as
+    performance_comparison/thread_scaling.py does.
+
+    """
+    for var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ[var] = str(num_threads)
+    theano.config.openmp = openmp
+    try:
+        # resize the pools of BLAS libraries that are already loaded
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(num_threads)
+    except ImportError:
+        print("Cannot resize the BLAS thread pool already loaded without threadpoolctl.")
+    if cpus is not None:
+        cpus = list(cpus)
+        os.environ['GOMP_CPU_AFFINITY'] = ' '.join([str(cpu) for cpu in cpus])
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cpus)
+        else:
+            try:
+                import psutil
+                psutil.Process().cpu_affinity(cpus)
+            except ImportError:
+                print("Cannot pin threads without os.sched_setaffinity or psutil.")
+
+
+#### Random number stream of the dropout masks
+# one stream shared by every dropout layer, so the masks of different
+# layers are independent; its state is a shared variable, saved with
+# the checkpoints of `Network.fit`
+srng = MRG_RandomStreams(seed=1234)
+
+def set_seed(seed):
+    """Reseed the dropout masks of the networks built afterwards, for
+    reproducible training runs."""
+    global srng
+    srng = MRG_RandomStreams(seed=seed)
+
+
 #### Main class used to construct and train networks
 
 class Network(object):
 
-    def __init__(self, layers):
+    def __init__(self, layers, recompute=()):
         """Takes a list of `layers`, describing the network architecture, and
         a value for the `mini_batch_size` to be used during training
         by stochastic gradient descent.
 
+        `recompute` lists the indices of layers whose intermediate values
+        are not kept for backpropagation but recomputed from their input
+        during it, trading training time for memory (see
+        `recompute_layer`).  Layers with dropout cannot be recomputed.
+
         """
         self.layers = layers
         self.params = [param for layer in self.layers for param in layer.params]
+        self.stats = [stat for layer in self.layers for stat in getattr(layer, 'stats', [])]
+        self.recompute = [layers[j] for j in recompute]
+        for layer in self.recompute:
+            if getattr(layer, 'p_dropout', 0):
+                raise ValueError("A layer with dropout cannot be recomputed: "+\
+                    "its masks would be drawn again.")
+        self.history = []
+
+    def __setstate__(self, state):
+        # networks pickled before `recompute`, `stats` and `history`
+        # existed keep every value and start with no statistics or history
+        state.setdefault('recompute', [])
+        state.setdefault('stats', [stat for layer in state['layers']
+                                   for stat in getattr(layer, 'stats', [])])
+        state.setdefault('history', [])
+        self.__dict__.update(state)
 
 
     def feedforward(self, mini_batch_size):
@@ -71,15 +180,70 @@ class Network(object):
         self.y = T.ivector("y")  # labels, presented as 1D vector of [int] labels
         init_layer = self.layers[0]
         init_layer.set_inpt(self.x, self.x, mini_batch_size)
+        if init_layer in self.recompute:
+            recompute_layer(init_layer, self.x, self.x, mini_batch_size)
         for j in xrange(1, len(self.layers)):
             prev_layer, layer = self.layers[j-1], self.layers[j]
             layer.set_inpt(
                 prev_layer.output, prev_layer.output_dropout, mini_batch_size)
+            if layer in self.recompute:
+                recompute_layer(layer, prev_layer.output,
+                                prev_layer.output_dropout, mini_batch_size)
 
 
     def fit(self, train_data, epochs, mini_batch_size, eta,
-            valid_data, test_data=None, lmbda=0.0, early_stop=False, optim_mode='gd'):
-        """Train the network using mini-batch stochastic gradient descent."""
+            valid_data, test_data=None, lmbda=0.0, early_stop=False, optim_mode='gd',
+            memory_budget=None, checkpoint=None, checkpoint_every=1000, resume=False,
+            compile_mode=None, warmup_epochs=0, lr_decay=None,
+            sampling='uniform', uniform_mix=0.5, score_every=1,
+            valid_subsample=None, confidence=0.95):
+        """Train the network using mini-batch stochastic gradient descent.
+        If `mini_batch_size` is 'auto', the largest one whose training
+        memory fits in `memory_budget` bytes is used.
+
+        `optim_mode` is 'gd', 'adam', or for large mini-batches 'lars' or
+        'lamb', which scale the step of each weight matrix by the ratio
+        of its norm to that of its update.  The learning rate (`eta`, or
+        Adam's own) can rise linearly from zero over the first
+        `warmup_epochs`, and then follow `lr_decay`: 'linear' or
+        'cosine' down to zero at the last epoch.
+
+        If a `checkpoint` file name is given, the complete training state
+        (parameters, optimizer state, epoch and mini-batch position,
+        early-stopping bookkeeping, data order and random number
+        generators) is saved there every `checkpoint_every` mini-batches.
+        With `resume=True` an existing checkpoint is loaded first, and
+        training continues from the mini-batch after it was saved.  The
+        data must be passed in its original order, as on the first run,
+        and a checkpoint saved with another mini-batch size, `optim_mode`,
+        `sampling` or layer configuration raises a ValueError.
+
+        The seconds spent compiling each Theano function are printed and
+        kept in `self.compile_times`.  With `compile_mode='tiered'`
+        training starts at once on a quickly compiled, lightly optimized
+        `train_mb`, and switches to the fully optimized one when its
+        compilation in a background thread finishes.
+
+        With `sampling='importance'` the mini-batches are drawn, with
+        replacement, with probability `uniform_mix`/N plus (1 -
+        `uniform_mix`) times each example's share of the total loss, and
+        each example's cost is weighted by 1/(N p) so that the gradient
+        stays unbiased.  The loss of an example is updated whenever it is
+        trained on, and recomputed for the whole training set every
+        `score_every` epochs; the seconds spent on that are kept in
+        `self.scoring_time`.
+
+        With `valid_subsample` set, each epoch's validation first scores
+        a random sample of about that many examples (whole mini-batches)
+        and goes on to the rest of the validation set only if the
+        `confidence` interval of the accuracy reaches the best so far;
+        otherwise the estimate is recorded in `self.history`.  A new best,
+        and so early stopping, always rests on the full validation set.
+        The estimated seconds saved are kept in `self.eval_time_saved`.
+
+        """
+        if sampling not in ('uniform', 'importance'):
+            raise ValueError("Unknown sampling {0}.".format(sampling))
         train_x, train_y = train_data
         valid_x, valid_y = valid_data
         if test_data:
@@ -87,54 +251,131 @@ class Network(object):
 
         ## Compute number of minibatches for training, validation and testing
         dataSize = size(train_data)
+        if mini_batch_size == 'auto':
+            if memory_budget is None:
+                raise ValueError("mini_batch_size='auto' needs a memory_budget.")
+            mini_batch_size = min(dataSize, size(valid_data), self.max_batch_size(
+                memory_budget, training=True, optim_mode=optim_mode))
+            print("Using a mini-batch size of {0}".format(mini_batch_size))
         num_train_batches = dataSize/mini_batch_size
         num_valid_batches = size(valid_data)/mini_batch_size
         if test_data:
             num_test_batches = size(test_data)/mini_batch_size
+        if valid_subsample:
+            num_sub_batches = min(num_valid_batches,
+                                  max(1, int(valid_subsample)/mini_batch_size))
+            # half-width of the interval, in standard errors
+            z = scipy.stats.norm.ppf(0.5 + confidence/2.0)
 
         ## Set the (regularized) cost function, symbolic gradients, and updates
         self.feedforward(mini_batch_size)
-        l2_norm_squared = sum([(layer.w**2).sum() for layer in self.layers])
-        cost = self.layers[-1].cost(self)+\
+        l2_norm_squared = sum([(layer.w**2).sum() for layer in self.layers
+                               if hasattr(layer, 'w')])
+        example_weights = T.vector("example_weights") # importance weights
+        if sampling == 'importance':
+            example_costs = self.layers[-1].example_costs(self)
+            data_cost = T.mean(example_weights*example_costs)
+        else:
+            data_cost = self.layers[-1].cost(self)
+        cost = data_cost+\
                0.5*lmbda*l2_norm_squared/mini_batch_size
-        if optim_mode=='gd':
-            grads = T.grad(cost, self.params)
-            updates = [(param, param-eta*grad)
-                        for param, grad in zip(self.params, grads)]
-        if optim_mode=='adam':
-            updates = Adam(cost, self.params)
-
-        ## Set functions to train a mini-batch, and to compute the
-        ## accuracy in validation and test mini-batches.
+        # multiplier of the learning rate, set by the schedule
+        lr_scale = theano.shared(np.asarray(1.0, dtype=theano.config.floatX))
+        scheduled = warmup_epochs > 0 or lr_decay is not None
+        updates = optimizer_updates(cost, self.params, optim_mode, eta, lr_scale)
+        # running statistics kept by batch normalization layers
+        updates += [update for layer in self.layers
+                    for update in getattr(layer, 'updates', [])]
+        # everything else a resumed run needs: the optimizer state and
+        # the random streams drawing the dropout masks
+        known = set([id(var) for var in self.params + self.stats])
+        optim_state = [var for var, _ in updates if id(var) not in known]
+        rng_state = [var for var in theano.gof.graph.inputs([cost])
+                     if hasattr(var, 'default_update')]
+        saved = self.params + self.stats + optim_state + rng_state
+
+        ## Set functions to train a mini-batch, to compute the accuracy
+        ## in validation and test mini-batches, and to shuffle the data.
+        ## Validation and test share one function, which picks the
+        ## dataset with its second argument.
         i = T.lscalar() # mini-batch index
-        train_mb = theano.function(
-            [i], cost, updates=updates,
-            givens={
-                self.x:
-                train_x[i*mini_batch_size: (i+1)*mini_batch_size],
-                self.y:
-                train_y[i*mini_batch_size: (i+1)*mini_batch_size]
-            })
-        validate_mb_accuracy = theano.function(
-            [i], self.layers[-1].accuracy(self.y),
-            givens={
-                self.x:
-                valid_x[i*mini_batch_size: (i+1)*mini_batch_size],
-                self.y:
-                valid_y[i*mini_batch_size: (i+1)*mini_batch_size]
-            })
+        d = T.lscalar() # dataset: 0 for validation, 1 for test
+        idx = T.ivector() # examples of an importance-sampled mini-batch
+        def compile_train_mb(mode=None):
+            if sampling == 'importance':
+                # the losses it returns rescore the sampled examples
+                return theano.function(
+                    [idx, example_weights], [cost, example_costs], updates=updates,
+                    givens={
+                        self.x: T.cast(train_x[idx], theano.config.floatX),
+                        self.y: train_y[idx]
+                    }, mode=mode)
+            return theano.function(
+                [i], cost, updates=updates,
+                givens={
+                    self.x:
+                    T.cast(train_x[i*mini_batch_size: (i+1)*mini_batch_size],
+                           theano.config.floatX),
+                    self.y:
+                    train_y[i*mini_batch_size: (i+1)*mini_batch_size]
+                }, mode=mode)
         if test_data:
-            test_mb_accuracy = theano.function(
-                [i], self.layers[-1].accuracy(self.y),
+            eval_x = ifelse(T.eq(d, 0),
+                            valid_x[i*mini_batch_size: (i+1)*mini_batch_size],
+                            test_x[i*mini_batch_size: (i+1)*mini_batch_size])
+            eval_y = ifelse(T.eq(d, 0),
+                            valid_y[i*mini_batch_size: (i+1)*mini_batch_size],
+                            test_y[i*mini_batch_size: (i+1)*mini_batch_size])
+        else:
+            eval_x = valid_x[i*mini_batch_size: (i+1)*mini_batch_size]
+            eval_y = valid_y[i*mini_batch_size: (i+1)*mini_batch_size]
+        orderMask = T.ivector()
+        self.compile_times = {}
+        t_compile = time()
+        evaluate_mb_accuracy = theano.function(
+            [i, d], self.layers[-1].accuracy(self.y),
+            givens={self.x: T.cast(eval_x, theano.config.floatX), self.y: eval_y},
+            on_unused_input='ignore')
+        self.compile_times['evaluate_mb_accuracy'] = time() - t_compile
+        t_compile = time()
+        shuffle = theano.function([orderMask], None, updates=[
+            (train_x, train_x[orderMask]), (train_y, train_y[orderMask])])
+        self.compile_times['shuffle'] = time() - t_compile
+        if sampling == 'importance':
+            t_compile = time()
+            score_mb = theano.function(
+                [i], self.layers[-1].example_costs(self, dropout=False),
                 givens={
                     self.x:
-                    test_x[i*mini_batch_size: (i+1)*mini_batch_size],
+                    T.cast(train_x[i*mini_batch_size: (i+1)*mini_batch_size],
+                           theano.config.floatX),
                     self.y:
-                    test_y[i*mini_batch_size: (i+1)*mini_batch_size]
+                    train_y[i*mini_batch_size: (i+1)*mini_batch_size]
                 })
-        orderMask = T.ivector()
-        shuffleData = theano.function([orderMask], None, updates=[(train_x, train_x[orderMask])])
-        shuffleLabel = theano.function([orderMask], None, updates=[(train_y, train_y[orderMask])])            
+            self.compile_times['score_mb'] = time() - t_compile
+        t_compile = time()
+        if compile_mode == 'tiered':
+            train_mb = compile_train_mb(theano.compile.mode.Mode(optimizer='fast_compile'))
+            self.compile_times['train_mb (fast)'] = time() - t_compile
+            # the optimized function is swapped in between mini-batches
+            # once the background compilation is done.  Theano's
+            # compilation is not thread-safe, so everything else is
+            # compiled before it starts, and fit waits for it to end.
+            optimized = {}
+            def compile_optimized():
+                t = time()
+                fn = compile_train_mb()
+                self.compile_times['train_mb'] = time() - t
+                optimized['train_mb'] = fn
+            compiler = threading.Thread(target=compile_optimized)
+            compiler.daemon = True
+        else:
+            train_mb = compile_train_mb()
+            self.compile_times['train_mb'] = time() - t_compile
+        for name in sorted(self.compile_times):
+            print("Compiled {0} in {1:.2f} seconds".format(name, self.compile_times[name]))
+        if compile_mode == 'tiered':
+            compiler.start()
 
         ## Train the model
         print("\nStart training......\n")
@@ -145,21 +386,121 @@ class Network(object):
                                    # considered significant
         
         best_valid_accuracy = 0.0
+        best_iter = 0
         done_looping = False
         epoch = 0
+        start_index = 0
+        data_order = np.arange(dataSize, dtype=np.int32)
+        scores = np.ones(dataSize) # losses for importance sampling
+        self.scoring_time = 0.0
+        self.eval_time_saved = 0.0
+        self.history = []
+        t0 = time()
+        if resume and checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint, 'rb') as f:
+                state = pickle.load(f)
+            if state['mini_batch_size'] != mini_batch_size:
+                raise ValueError("The checkpoint was saved with a mini-batch size of {0}.".format(
+                    state['mini_batch_size']))
+            if state['precision'] != STORAGE_DTYPE:
+                print("The checkpoint was saved under the {0} precision policy.".format(
+                    state['precision']))
+            for key, value in [('optim_mode', optim_mode), ('sampling', sampling)]:
+                if state.get(key) != value:
+                    raise ValueError("The checkpoint was saved with {0}={1!r}.".format(
+                        key, state.get(key)))
+            shapes = [np.shape(var.get_value(borrow=True)) for var in saved]
+            if state.get('shapes') != shapes:
+                raise ValueError("The checkpoint holds {0} variables of shapes {1}, "
+                                 "but this network and optimizer have {2} of shapes {3}.".format(
+                                     len(state['shared']), state.get('shapes'),
+                                     len(shapes), shapes))
+            for var, value in zip(saved, state['shared']):
+                if isinstance(value, np.ndarray):
+                    value = np.asarray(value, dtype=var.dtype)
+                var.set_value(value)
+            np.random.set_state(state['np_random'])
+            data_order = state['data_order']
+            shuffle(data_order)
+            epoch, start_index = state['epoch'], state['minibatch_index']
+            patience = state['patience']
+            best_valid_accuracy, best_iter = state['best_valid_accuracy'], state['best_iter']
+            self.history = state['history']
+            scores = state['scores']
+            self.scoring_time = state['scoring_time']
+            self.eval_time_saved = state['eval_time_saved']
+            t0 = time() - state['elapsed']
+            print("Resuming from epoch {0}, mini-batch {1}".format(
+                epoch+1, start_index))
+        # the losses are drawn from and updated a mini-batch at a time
+        scores = SumTree(scores)
         while (epoch < epochs) and (not done_looping):
             epoch = epoch + 1
-            for minibatch_index in xrange(num_train_batches):
+            if sampling == 'importance' and start_index == 0 and \
+                    epoch > 1 and (epoch-1) % score_every == 0:
+                # refresh the stale losses of the examples not sampled lately
+                t_score = time()
+                scores.update(np.arange(num_train_batches*mini_batch_size), np.concatenate(
+                    [score_mb(j) for j in xrange(num_train_batches)]))
+                self.scoring_time += time() - t_score
+            for minibatch_index in xrange(start_index, num_train_batches):
                 iter = num_train_batches*(epoch-1) + minibatch_index + 1
                 if iter % 1000 == 0:
                     print("Training mini-batch number {0}".format(iter))
-                cost_ij = train_mb(minibatch_index)
+                if scheduled:
+                    lr_scale.set_value(np.asarray(lr_schedule(
+                        iter-1, epochs*num_train_batches,
+                        int(warmup_epochs*num_train_batches), lr_decay),
+                        dtype=theano.config.floatX))
+                if compile_mode == 'tiered' and 'train_mb' in optimized:
+                    train_mb = optimized.pop('train_mb')
+                    print("Switched to the optimized train_mb after {0:.2f} seconds".format(
+                        self.compile_times['train_mb']))
+                if sampling == 'importance':
+                    batch = scores.sample(mini_batch_size)
+                    uniform = np.random.uniform(size=mini_batch_size) < uniform_mix
+                    batch[uniform] = np.random.randint(dataSize, size=uniform.sum())
+                    batch = batch.astype(np.int32)
+                    p = uniform_mix/float(dataSize) + \
+                        (1-uniform_mix)*scores[batch]/scores.total()
+                    weights = np.asarray(1.0/(dataSize*p), dtype=theano.config.floatX)
+                    cost_ij, losses = train_mb(batch, weights)
+                    scores.update(batch, losses)
+                else:
+                    cost_ij = train_mb(minibatch_index)
                 if iter % num_train_batches == 0:
-                    valid_accuracy = np.mean(
-                        [validate_mb_accuracy(j) for j in xrange(num_valid_batches)])
-                    print("Epoch {0}: validation accuracy {1:.2%}".format(
-                        epoch, valid_accuracy))
-                    if valid_accuracy >= best_valid_accuracy:
+                    if valid_subsample:
+                        t_eval = time()
+                        valid_order = np.random.permutation(num_valid_batches)
+                        accuracies = [evaluate_mb_accuracy(j, 0)
+                                      for j in valid_order[:num_sub_batches]]
+                        valid_accuracy = np.mean(accuracies)
+                        # normal approximation of the binomial, with the
+                        # finite population correction
+                        n = num_sub_batches*mini_batch_size
+                        N = num_valid_batches*mini_batch_size
+                        half_width = z*np.sqrt(valid_accuracy*(1-valid_accuracy)/n *
+                                               (N-n)/max(N-1, 1))
+                        full = valid_accuracy + half_width >= best_valid_accuracy
+                        if full:
+                            accuracies += [evaluate_mb_accuracy(j, 0)
+                                           for j in valid_order[num_sub_batches:]]
+                            valid_accuracy = np.mean(accuracies)
+                        else:
+                            self.eval_time_saved += (time() - t_eval) * \
+                                (num_valid_batches - num_sub_batches) / float(num_sub_batches)
+                    else:
+                        full = True
+                        valid_accuracy = np.mean(
+                            [evaluate_mb_accuracy(j, 0) for j in xrange(num_valid_batches)])
+                    if full:
+                        print("Epoch {0}: validation accuracy {1:.2%}".format(
+                            epoch, valid_accuracy))
+                    else:
+                        print("Epoch {0}: validation accuracy {1:.2%} +/- {2:.2%} "
+                              "(subsample)".format(epoch, valid_accuracy, half_width))
+                    self.history.append((epoch, time()-t0, valid_accuracy))
+                    if full and valid_accuracy >= best_valid_accuracy:
                         if valid_accuracy >= (best_valid_accuracy * \
                             improve_threshold) and early_stop:
                             patience = max(patience, iter * patience_increase)
@@ -168,7 +509,7 @@ class Network(object):
                         best_iter = iter
                         if test_data:
                             test_accuracy = np.mean(
-                                [test_mb_accuracy(j) for j in xrange(num_test_batches)])
+                                [evaluate_mb_accuracy(j, 1) for j in xrange(num_test_batches)])
                             print('The corresponding test accuracy is {0:.2%}'.format(
                                 test_accuracy))
                         # save the best model
@@ -178,28 +519,652 @@ class Network(object):
                 if early_stop and patience <= iter:
                     done_looping = True
                     break
-            # shuffle the data
-            order = np.random.permutation(np.arange(dataSize, dtype=np.int32))
-            shuffleData(order)
-            shuffleLabel(order)
+                if checkpoint and iter % checkpoint_every == 0:
+                    values = [var.get_value() for var in saved]
+                    state = {
+                        'mini_batch_size': mini_batch_size,
+                        'precision': STORAGE_DTYPE,
+                        'optim_mode': optim_mode,
+                        'sampling': sampling,
+                        'shapes': [np.shape(value) for value in values],
+                        'shared': values,
+                        'np_random': np.random.get_state(),
+                        'data_order': data_order,
+                        'epoch': epoch-1,
+                        'minibatch_index': minibatch_index+1,
+                        'patience': patience,
+                        'best_valid_accuracy': best_valid_accuracy,
+                        'best_iter': best_iter,
+                        'history': self.history,
+                        'scores': scores[np.arange(dataSize)],
+                        'scoring_time': self.scoring_time,
+                        'eval_time_saved': self.eval_time_saved,
+                        'elapsed': time()-t0}
+                    # write then rename, so an interruption never leaves
+                    # a truncated checkpoint behind
+                    with open(checkpoint + '.tmp', 'wb') as f:
+                        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+                    os.rename(checkpoint + '.tmp', checkpoint)
+            start_index = 0
+            if sampling == 'uniform':
+                # shuffle the data
+                order = np.random.permutation(np.arange(dataSize, dtype=np.int32))
+                shuffle(order)
+                data_order = data_order[order]
         
+        if compile_mode == 'tiered':
+            compiler.join()
         print("Finished training network.")
+        if sampling == 'importance':
+            print("Spent {0:.2f} seconds rescoring the training set".format(
+                self.scoring_time))
+        if valid_subsample:
+            print("Saved about {0:.2f} seconds of validation".format(
+                self.eval_time_saved))
         print("Best validation accuracy of {0:.2%} obtained at iteration {1}".format(
             best_valid_accuracy, best_iter))
 
     
-    def predict(self, test_data):
+    def predict(self, test_data, mini_batch_size=None, memory_budget=None):
         """Output the predicted values from trained model (the net). The
         data input is a theano shared variable array.
 
+        By default the whole array goes through the net at once.  Give
+        `mini_batch_size`, or a `memory_budget` in bytes to use the
+        largest batch that fits, to predict it batch by batch instead.
+
         """
-        self.feedforward(test_data.get_value().shape[0])
+        n = test_data.get_value(borrow=True).shape[0]
+        if mini_batch_size is None and memory_budget is not None:
+            mini_batch_size = self.max_batch_size(memory_budget, training=False)
+        if mini_batch_size is None or mini_batch_size > n:
+            mini_batch_size = n
+        num_batches = n/mini_batch_size
+        i = T.lscalar() # mini-batch index
+        self.feedforward(mini_batch_size)
         prediction = theano.function(
-            inputs=[],
+            inputs=[i],
             outputs=self.layers[-1].y_out,
-            givens={self.x: test_data})
-        return prediction()
+            givens={self.x: T.cast(test_data[i*mini_batch_size: (i+1)*mini_batch_size],
+                                   theano.config.floatX)})
+        preds = [prediction(j) for j in xrange(num_batches)]
+        tail = n - num_batches*mini_batch_size
+        if tail:
+            self.feedforward(tail)
+            prediction = theano.function(
+                inputs=[],
+                outputs=self.layers[-1].y_out,
+                givens={self.x: T.cast(test_data[num_batches*mini_batch_size:],
+                                       theano.config.floatX)})
+            preds.append(prediction())
+        return np.concatenate(preds)
+
+    def memory_usage(self, mini_batch_size, training=True, optim_mode='gd'):
+        """Return a static estimate, in bytes, of the memory needed to run
+        the net on mini-batches of `mini_batch_size`, as a dict with the
+        'params', 'activations', 'gradients' and 'total' bytes.
+
+        In training every layer output and the intermediates kept for
+        backpropagation (`inner_size`, unless the layer is recomputed)
+        stay alive until the backward pass, which needs the gradients of
+        one layer's input, inner values and output at a time; the
+        parameters have gradients and the optimizer's state.  In inference only the input,
+        inner values and output of one layer are alive at a time.
+
+        """
+        itemsize = np.dtype(theano.config.floatX).itemsize
+        n_params = sum([param.get_value(borrow=True).size for param in self.params])
+        n_stats = sum([stat.get_value(borrow=True).size for stat in self.stats])
+        per_layer = [int(np.prod(layer.in_shape)) + layer.inner_size +
+                     int(np.prod(layer.out_shape)) for layer in self.layers]
+        if training:
+            # parameters, gradients and the optimizer's per-weight state
+            copies = {'adam': 4, 'lamb': 4, 'lars': 3}.get(optim_mode, 2)
+            params = n_params * copies + n_stats
+            activations = int(np.prod(self.layers[0].in_shape)) + sum(
+                [(0 if layer in self.recompute else layer.inner_size) +
+                 int(np.prod(layer.out_shape)) for layer in self.layers])
+            gradients = max(per_layer)
+        else:
+            params = n_params + n_stats
+            activations = max(per_layer)
+            gradients = 0
+        usage = {'params': itemsize*params,
+                 'activations': itemsize*mini_batch_size*activations,
+                 'gradients': itemsize*mini_batch_size*gradients}
+        usage['total'] = sum(usage.values())
+        return usage
+
+    def max_batch_size(self, memory_budget, training=True, optim_mode='gd'):
+        """Return the largest mini-batch size whose `memory_usage` fits in
+        `memory_budget` bytes."""
+        one = self.memory_usage(1, training, optim_mode)['total']
+        per_example = self.memory_usage(2, training, optim_mode)['total'] - one
+        mini_batch_size = (memory_budget - one) // per_example + 1
+        if mini_batch_size < 1:
+            raise ValueError("A memory budget of {0} bytes cannot fit a single example.".format(
+                memory_budget))
+        return int(mini_batch_size)
+
+    def fold_batch_norm(self):
+        """Fold every `BatchNormLayer` into the `w` and `b` of the layer
+        preceding it, using the running statistics gathered in training.
+        The resulting network computes the same inference output with
+        no normalization cost, and is the one to export.  The network is
+        modified in place and returned.
+
+        """
+        layers = []
+        for layer in self.layers:
+            if isinstance(layer, BatchNormLayer):
+                if not layers:
+                    raise ValueError("A BatchNormLayer needs a preceding layer to fold into.")
+                layer.fold_into(layers[-1])
+            else:
+                layers.append(layer)
+        self.layers = layers
+        self.params = [param for layer in self.layers for param in layer.params]
+        self.stats = [stat for layer in self.layers for stat in getattr(layer, 'stats', [])]
+        return self
+
+    def export(self, filename):
+        """Write the net for inference workers: the architecture goes to
+        the small JSON descriptor `filename`.json, and all the weights
+        and statistics to the single file `filename`.weights, each array
+        aligned on a 64-byte boundary.  `load_model` maps the weights
+        read-only, so any number of worker processes loading the same
+        model share one physical copy of them.  Fold batch
+        normalization first, if the net uses it.
+
+        """
+        specs, offset = [], 0
+        with open(filename + '.weights', 'wb') as f:
+            for layer in self.layers:
+                spec = {'type': type(layer).__name__, 'args': {}, 'arrays': []}
+                for name in layer._init_args:
+                    value = getattr(layer, name)
+                    if name == 'activation_fn':
+                        names = [key for key, fn in ACTIVATIONS.items() if fn is value]
+                        if not names:
+                            raise ValueError("Cannot export the activation function {0}: "
+                                             "it is not in ACTIVATIONS.".format(value))
+                        value = names[0]
+                    spec['args'][name] = value
+                for name, var in shared_attributes(layer):
+                    value = np.ascontiguousarray(var.get_value(borrow=True))
+                    padding = -offset % 64
+                    f.write(b'\0' * padding)
+                    offset += padding
+                    spec['arrays'].append({'name': name, 'dtype': value.dtype.str,
+                                           'shape': value.shape, 'offset': offset})
+                    f.write(value.tostring())
+                    offset += value.nbytes
+                specs.append(spec)
+        with open(filename + '.json', 'w') as f:
+            json.dump({'layers': specs, 'dropout_scaling': 'inverted'}, f, indent=2)
+
+    def profile(self, mini_batch_size, n_iter=20, optim_mode='gd', eta=0.1,
+                json_file=None):
+        """Time each layer in isolation on random mini-batches, and return
+        a list with one dict per layer (plus a final total) holding the
+        mean forward, backward and update times in seconds, the
+        analytic forward and backward FLOPs, the achieved GFLOP/s, and
+        the parameter and output activation bytes.  The forward time is
+        that of the training path, so it includes dropout masks; the
+        update uses `optim_mode` as in `fit`.  If `json_file` is given
+        the report is also written there; `profile_table` formats it.
+
+        The parameters are restored afterwards, but the symbolic graph
+        is not, so call `fit` or `predict` to rebuild it.
+
+        """
+        saved = [var.get_value() for var in self.params + self.stats]
+        report = []
+        for j, layer in enumerate(self.layers):
+            times = time_layer(layer, mini_batch_size, n_iter, optim_mode, eta)
+            t_forward = np.mean(times['forward'])
+            t_backward = np.mean(times['backward']) - t_forward
+            t_update = np.mean(times['update']) - t_forward - t_backward
+            flops = layer.flops() * mini_batch_size
+            itemsize = np.dtype(theano.config.floatX).itemsize
+            report.append({
+                'layer': '{0} {1}'.format(j, type(layer).__name__),
+                'forward_s': t_forward,
+                'backward_s': max(t_backward, 0.0),
+                'update_s': max(t_update, 0.0),
+                'forward_flops': flops,
+                'backward_flops': 2*flops,
+                'forward_gflops_per_s': flops / t_forward / 1e9,
+                'backward_gflops_per_s': 2*flops / max(t_backward, 1e-12) / 1e9,
+                'param_bytes': sum([param.get_value(borrow=True).nbytes
+                                    for param in layer.params]),
+                'activation_bytes': mini_batch_size * int(np.prod(layer.out_shape)) * itemsize})
+        total = {'layer': 'total'}
+        for key in report[0]:
+            if key != 'layer' and not key.endswith('per_s'):
+                total[key] = sum([row[key] for row in report])
+        total['forward_gflops_per_s'] = total['forward_flops'] / total['forward_s'] / 1e9
+        total['backward_gflops_per_s'] = \
+            total['backward_flops'] / max(total['backward_s'], 1e-12) / 1e9
+        report.append(total)
+        for var, value in zip(self.params + self.stats, saved):
+            var.set_value(value)
+        if json_file:
+            with open(json_file, 'w') as f:
+                json.dump(report, f, indent=2)
+        return report
+
+
+#### Online fine-tuning from a stream of labelled examples
+
+class OnlineTrainer(object):
+    """Used to keep a trained network up to date with newly labelled
+    examples as they arrive, at a cost proportional to the new data.
+    Every training step mixes new examples with examples replayed from
+    a reservoir -- a uniform sample of all the examples seen, original
+    and new -- so that the net does not forget the original data.  The
+    net's parameters are updated in place, and the optimizer state
+    carries over from one call of `update` to the next.
+
+    """
+
+    def __init__(self, net, replay_data, mini_batch_size, eta, replay_ratio=1.0,
+                 reservoir_size=10000, lmbda=0.0, optim_mode='gd'):
+        """`replay_data` is the original training data, a tuple of numpy
+        arrays or theano shared variables; `reservoir_size` of its
+        examples, drawn uniformly, seed the reservoir.  Each step of
+        `mini_batch_size` examples has `replay_ratio` replayed examples
+        for each new one.  `eta`, `lmbda` and `optim_mode` are as in
+        `Network.fit`.
+
+        """
+        replay_x, replay_y = [data.get_value() if hasattr(data, 'get_value') else data
+                              for data in replay_data]
+        n = replay_x.shape[0]
+        keep = np.random.choice(n, min(reservoir_size, n), replace=False)
+        self.reservoir_x = np.asarray(replay_x[keep], dtype=theano.config.floatX)
+        self.reservoir_y = np.asarray(replay_y[keep], dtype='int32')
+        self.reservoir_size = reservoir_size
+        self.seen = n
+        self.net = net
+        self.mini_batch_size = mini_batch_size
+        self.n_new = max(1, int(round(mini_batch_size / (1.0 + replay_ratio))))
+        net.feedforward(mini_batch_size)
+        l2_norm_squared = sum([(layer.w**2).sum() for layer in net.layers
+                               if hasattr(layer, 'w')])
+        cost = net.layers[-1].cost(net)+\
+               0.5*lmbda*l2_norm_squared/mini_batch_size
+        updates = optimizer_updates(cost, net.params, optim_mode, eta)
+        updates += [update for layer in net.layers
+                    for update in getattr(layer, 'updates', [])]
+        self.train_mb = theano.function([net.x, net.y], cost, updates=updates)
 
+    def update(self, x, y):
+        """Train the net on the new labelled examples `x`, `y` (numpy
+        arrays), each step topped up with replayed examples, then add
+        them to the reservoir.  Return the mean training cost.
+
+        """
+        x = np.asarray(x, dtype=theano.config.floatX)
+        y = np.asarray(y, dtype='int32')
+        costs = []
+        for start in xrange(0, x.shape[0], self.n_new):
+            new_x, new_y = x[start:start+self.n_new], y[start:start+self.n_new]
+            replay = np.random.randint(self.reservoir_x.shape[0],
+                                       size=self.mini_batch_size - new_x.shape[0])
+            costs.append(self.train_mb(
+                np.concatenate([new_x, self.reservoir_x[replay]]),
+                np.concatenate([new_y, self.reservoir_y[replay]])))
+        # reservoir sampling keeps a uniform sample of everything seen
+        for j in xrange(x.shape[0]):
+            self.seen += 1
+            if self.reservoir_x.shape[0] < self.reservoir_size:
+                self.reservoir_x = np.concatenate([self.reservoir_x, x[j:j+1]])
+                self.reservoir_y = np.concatenate([self.reservoir_y, y[j:j+1]])
+            else:
+                k = np.random.randint(self.seen)
+                if k < self.reservoir_size:
+                    self.reservoir_x[k], self.reservoir_y[k] = x[j], y[j]
+        return np.mean(costs)
+
+
+#### Ensembles of trained networks
+
+class Ensemble(object):
+    """Used to predict with several trained networks of the same
+    architecture together, averaging their softmax outputs over shifted
+    views of each image (test-time augmentation).  All the members and
+    views go through one compiled forward pass (see `stacked_forward`):
+    each `ConvPoolLayer` of the members becomes a single grouped
+    convolution over their stacked filters, the dense and softmax
+    layers batched matrix products over the stacked weights, and the
+    views are concatenated along the batch axis.  The grouped
+    convolution needs Theano 1.0 or later.
+
+    """
+
+    def __init__(self, nets, shifts=((0, 0),), image_shape=(1, 28, 28), fill_value=0.0):
+        """`nets` is a list of trained `Network`s with identical layer
+        shapes, pooling and activation functions; their weights are
+        copied when the ensemble is built.
+
+        `shifts` lists the (rows, columns) offsets of the views of each
+        image, (0, 0) being the image itself, and the pixels uncovered
+        by a shift are set to `fill_value` -- the value of a blank
+        pixel after any input normalization.
+
+        """
+        shapes = [[layer_signature(layer) for layer in net.layers] for net in nets]
+        for shape in shapes[1:]:
+            if shape != shapes[0]:
+                raise ValueError("The networks of an ensemble must have identical layer "
+                                 "shapes, pooling and activation functions.")
+        self.nets = nets
+        self.shifts = list(shifts)
+        self.image_shape = tuple(image_shape)
+        self.fill_value = fill_value
+        # the other layer types run member by member
+        self.members = [list(layers) for layers in zip(*[net.layers for net in nets])]
+        self.stacked = [stack_weights(layers) if isinstance(layers[0], STACKABLE) else None
+                        for layers in self.members]
+        self.predict_fns = {}
+
+    def shift(self, images, dy, dx):
+        """Return the (batch, channels, height, width) `images` moved down
+        by `dy` rows and right by `dx` columns."""
+        if dy == 0 and dx == 0:
+            return images
+        h, w = self.image_shape[1:]
+        p = max(abs(dy), abs(dx))
+        padded = T.alloc(np.asarray(self.fill_value, dtype=images.dtype),
+                         images.shape[0], images.shape[1], h+2*p, w+2*p)
+        padded = T.set_subtensor(padded[:, :, p:p+h, p:p+w], images)
+        return padded[:, :, p-dy:p-dy+h, p-dx:p-dx+w]
+
+    def feedforward(self, x, mini_batch_size):
+        """Return the symbolic mean softmax output of all members and views
+        for the mini-batch `x` of rasterized images."""
+        K, V = len(self.nets), len(self.shifts)
+        images = x.reshape((mini_batch_size,) + self.image_shape)
+        inpt = T.concatenate([self.shift(images, dy, dx) for dy, dx in self.shifts])
+        outputs = stacked_forward(self.members, self.stacked, inpt, V*mini_batch_size)
+        n_out = self.nets[0].layers[-1].out_shape[0]
+        return outputs.reshape((K, V, mini_batch_size, n_out)).mean(axis=(0, 1))
+
+    def predict(self, test_data, mini_batch_size=None, proba=False):
+        """Output the ensemble's predicted labels for `test_data`, a theano
+        shared variable or numpy array, or their averaged probabilities
+        if `proba` is true.  The forward pass is compiled once per
+        mini-batch size and kept for later calls.
+
+        """
+        if hasattr(test_data, 'get_value'):
+            test_data = test_data.get_value(borrow=True)
+        n = test_data.shape[0]
+        if mini_batch_size is None or mini_batch_size > n:
+            mini_batch_size = n
+        outputs = []
+        for start in xrange(0, n, mini_batch_size):
+            batch = test_data[start:start+mini_batch_size]
+            size = batch.shape[0]
+            if size not in self.predict_fns:
+                x = T.matrix("x")
+                probs = self.feedforward(x, size)
+                self.predict_fns[size] = theano.function(
+                    [x], [probs, T.argmax(probs, axis=1)])
+            probs, labels = self.predict_fns[size](batch)
+            outputs.append(probs if proba else labels)
+        return np.concatenate(outputs)
+
+
+#### Training many networks of the same shapes together
+class MultiNetwork(object):
+    """Used to train several networks of identical layer shapes -- the
+    runs of a hyperparameter sweep, or the members of an ensemble -- in
+    one compiled training step instead of one per network.  The
+    parameters of the K networks are stacked along a leading axis: the
+    convolutions become a single grouped convolution with K groups and
+    the dense and softmax layers batched matrix products, so each call
+    does K times the work for about the same Python and dispatch
+    overhead.  Every network sees the same mini-batches, with its own
+    dropout masks, learning rate and L2 regularization.
+
+    Supports `ConvPoolLayer`s, `FullyConnectedLayer`s and a final
+    `SoftmaxLayer`, through `stacked_forward` as in an `Ensemble`.  The
+    grouped convolution needs Theano 1.0 or later.
+
+    """
+
+    def __init__(self, nets):
+        """`nets` is a list of `Network`s with identical layer shapes,
+        activation functions and dropout; their current weights are the
+        starting point of the training.
+
+        """
+        shapes = [[layer_signature(layer) for layer in net.layers] for net in nets]
+        for shape in shapes[1:]:
+            if shape != shapes[0]:
+                raise ValueError("The networks must have identical layer shapes.")
+        for layer in nets[0].layers:
+            if not isinstance(layer, STACKABLE):
+                raise ValueError("Cannot stack a {0}.".format(type(layer).__name__))
+        if not isinstance(nets[0].layers[-1], SoftmaxLayer):
+            raise ValueError("The last layer must be a SoftmaxLayer.")
+        self.nets = nets
+        self.K = len(nets)
+        self.layers = nets[0].layers
+        self.members = [list(layers) for layers in zip(*[net.layers for net in nets])]
+        self.stacked = [stack_weights(layers) for layers in self.members]
+        self.params = [param for pair in self.stacked for param in pair]
+        self.history = []
+
+    def feedforward(self, x, mini_batch_size, dropout=False):
+        """Return the symbolic (models, batch, classes) softmax outputs of
+        all the networks for the mini-batch `x` of rasterized images,
+        through the dropout path if `dropout` is true."""
+        return stacked_forward(self.members, self.stacked, x, mini_batch_size, dropout)
+
+    def fit(self, train_data, epochs, mini_batch_size, eta, valid_data,
+            lmbda=0.0, optim_mode='gd'):
+        """Train all the networks by mini-batch stochastic gradient
+        descent, as `Network.fit` does.  `eta` and `lmbda` are numbers,
+        or sequences with one value per network; with `optim_mode`
+        'adam', `eta` is Adam's learning rate (0.001 in `Network.fit`).
+
+        The validation accuracy of every network is printed each epoch,
+        and recorded both in `self.history`, as (epoch, seconds, array of
+        accuracies), and in the history of each network.  The trained
+        weights are copied back into the networks at the end.
+
+        """
+        if optim_mode not in ('gd', 'adam'):
+            raise ValueError("Unknown optim_mode {0}.".format(optim_mode))
+        K = self.K
+        train_x, train_y = train_data
+        valid_x, valid_y = valid_data
+        dataSize = size(train_data)
+        num_train_batches = dataSize/mini_batch_size
+        num_valid_batches = size(valid_data)/mini_batch_size
+        per_model = lambda value: theano.shared(
+            np.asarray(np.broadcast_to(value, (K,)), dtype=theano.config.floatX))
+        eta, lmbda = per_model(eta), per_model(lmbda)
+
+        ## Set the (regularized) cost of every network; their sum has
+        ## the gradients of each network's own cost
+        self.x = T.matrix("x")
+        self.y = T.ivector("y")
+        probs = self.feedforward(self.x, mini_batch_size, dropout=True)
+        n_out = self.layers[-1].n_out
+        picked = probs.reshape((K*mini_batch_size, n_out))[
+            T.arange(K*mini_batch_size), T.tile(self.y, (K,))]
+        costs = -T.log(picked).reshape((K, mini_batch_size)).mean(axis=1)
+        l2_norm_squared = sum([(w.reshape((K, -1))**2).sum(axis=1) for w, _ in self.stacked])
+        costs = costs + 0.5*lmbda*l2_norm_squared/mini_batch_size
+        # unit steps, then scaled by each network's learning rate
+        if optim_mode == 'gd':
+            steps = optimizer_updates(T.sum(costs), self.params, 'gd', 1.0)
+        else:
+            steps = Adam(T.sum(costs), self.params, lr=1.0)
+        known = set([id(param) for param in self.params])
+        updates = [(var, var + eta.dimshuffle((0,) + ('x',)*(var.ndim-1))*(new - var))
+                   if id(var) in known else (var, new) for var, new in steps]
+        test_probs = self.feedforward(self.x, mini_batch_size)
+        accuracies = T.mean(T.eq(T.argmax(test_probs, axis=2), self.y.dimshuffle('x', 0)),
+                            axis=1)
+
+        i = T.lscalar() # mini-batch index
+        train_mb = theano.function(
+            [i], costs, updates=updates,
+            givens={
+                self.x: T.cast(train_x[i*mini_batch_size: (i+1)*mini_batch_size],
+                               theano.config.floatX),
+                self.y: train_y[i*mini_batch_size: (i+1)*mini_batch_size]
+            })
+        validate_mb = theano.function(
+            [i], accuracies,
+            givens={
+                self.x: T.cast(valid_x[i*mini_batch_size: (i+1)*mini_batch_size],
+                               theano.config.floatX),
+                self.y: valid_y[i*mini_batch_size: (i+1)*mini_batch_size]
+            })
+        orderMask = T.ivector()
+        shuffle = theano.function([orderMask], None, updates=[
+            (train_x, train_x[orderMask]), (train_y, train_y[orderMask])])
+
+        ## Train the models
+        print("\nStart training {0} networks......\n".format(K))
+        self.history = []
+        for net in self.nets:
+            net.history = []
+        t0 = time()
+        for epoch in xrange(1, epochs+1):
+            for minibatch_index in xrange(num_train_batches):
+                train_mb(minibatch_index)
+            valid_accuracies = np.mean(
+                [validate_mb(j) for j in xrange(num_valid_batches)], axis=0)
+            elapsed = time() - t0
+            print("Epoch {0}: validation accuracies {1}".format(
+                epoch, " ".join(["{0:.2%}".format(a) for a in valid_accuracies])))
+            self.history.append((epoch, elapsed, valid_accuracies))
+            for net, accuracy in zip(self.nets, valid_accuracies):
+                net.history.append((epoch, elapsed, accuracy))
+            order = np.random.permutation(np.arange(dataSize, dtype=np.int32))
+            shuffle(order)
+        self.unstack()
+        print("Finished training {0} networks in {1:.2f} seconds.".format(K, time() - t0))
+
+    def unstack(self):
+        "Copy the stacked weights back into the layers of each network."
+        for j, (w, b) in enumerate(self.stacked):
+            w_value, b_value = w.get_value(), b.get_value()
+            for k, net in enumerate(self.nets):
+                net.layers[j].w.set_value(w_value[k])
+                net.layers[j].b.set_value(b_value[k])
+
+
+#### Caching predictions of repeated inputs
+
+class PredictionCache(object):
+    """Used in front of the `predict` of a `Network` or `Ensemble` to
+    serve inputs seen before without a forward pass.  Entries are keyed
+    by a hash of the model version and the raw bytes of the input row,
+    and the least recently used ones are evicted beyond `max_size`.
+
+    """
+
+    def __init__(self, net, model_version, max_size=100000, filename=None,
+                 mini_batch_size=100):
+        """`model_version` names the weights of `net`; cached predictions of
+        any other version are never served.  If `filename` is given the
+        cache is loaded from it when it exists, and `save` writes it
+        there.  The rows missing from the cache go through the net in
+        mini-batches of `mini_batch_size`, the last one padded, so that
+        a single forward function, compiled on first use, serves any
+        number of misses.
+
+        """
+        self.net = net
+        self.model_version = str(model_version)
+        self.max_size = max_size
+        self.filename = filename
+        self.mini_batch_size = mini_batch_size
+        self.predict_fn = None
+        self.entries = OrderedDict()
+        self.requests = 0  # rows asked for
+        self.hits = 0      # distinct rows found in the cache
+        self.computed = 0  # distinct rows sent through the net
+        if filename and os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                model_version, entries = pickle.load(f)
+            if model_version == self.model_version:
+                self.entries = entries
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+
+    def key(self, row):
+        return hashlib.sha1(self.model_version.encode() + row.tobytes()).digest()
+
+    def predict(self, data):
+        """Return the predictions for the rows of `data`, a theano shared
+        variable or numpy array.  Duplicate rows are sent through the
+        net once, with the rows missing from the cache, and the results
+        are put back in the order of `data`.
+
+        """
+        if hasattr(data, 'get_value'):
+            data = data.get_value(borrow=True)
+        data = np.ascontiguousarray(data, dtype=theano.config.floatX)
+        rows = data.view(np.dtype((np.void, data.dtype.itemsize*data.shape[1]))).ravel()
+        _, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+        keys = [self.key(data[j]) for j in first]
+        results = [None] * len(keys)
+        missing = []
+        for u, key in enumerate(keys):
+            if key in self.entries:
+                results[u] = self.entries.pop(key)
+                self.entries[key] = results[u] # most recently used
+            else:
+                missing.append(u)
+        if missing:
+            for u, result in zip(missing, self.forward(data[first[missing]])):
+                results[u] = result
+                self.entries[keys[u]] = result
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        self.requests += data.shape[0]
+        self.hits += len(keys) - len(missing)
+        self.computed += len(missing)
+        return np.asarray(results)[inverse]
+
+    def forward(self, data):
+        """Return the net's predictions for the rows of the numpy array
+        `data`, padded to whole mini-batches."""
+        B, n = self.mini_batch_size, data.shape[0]
+        padded = np.zeros((-(-n // B) * B, data.shape[1]), dtype=data.dtype)
+        padded[:n] = data
+        if isinstance(self.net, Ensemble):
+            # the ensemble keeps its forward function per mini-batch size
+            return self.net.predict(padded, B)[:n]
+        if self.predict_fn is None:
+            self.net.feedforward(B)
+            self.predict_fn = theano.function([self.net.x], self.net.layers[-1].y_out)
+        return np.concatenate([self.predict_fn(padded[j:j+B])
+                               for j in xrange(0, padded.shape[0], B)])[:n]
+
+    def metrics(self):
+        """Return the number of rows requested, distinct cache hits and
+        rows computed, the cache size, and the hit rate: the fraction
+        of requested rows that needed no forward pass."""
+        return {'requests': self.requests, 'hits': self.hits,
+                'computed': self.computed, 'size': len(self.entries),
+                'hit_rate': 1 - float(self.computed) / max(self.requests, 1)}
+
+    def save(self):
+        "Write the cache to `self.filename`."
+        with open(self.filename + '.tmp', 'wb') as f:
+            pickle.dump((self.model_version, self.entries), f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(self.filename + '.tmp', self.filename)
 
 
 #### Define layer types
@@ -211,9 +1176,10 @@ class ConvPoolLayer(object):
     simplifies the code, so it makes sense to combine them.
 
     """
+    _init_args = ('filter_shape', 'image_shape', 'poolsize', 'activation_fn', 'algo')
 
     def __init__(self, filter_shape, image_shape, poolsize=(2, 2),
-                 activation_fn=sigmoid, init='trunc_normal'):
+                 activation_fn=sigmoid, init='trunc_normal', algo=None, weights=None):
         """`filter_shape` is a tuple of length 4, whose entries are the number
         of filters, the number of input feature maps, the filter height, and the
         filter width.
@@ -225,133 +1191,847 @@ class ConvPoolLayer(object):
         `poolsize` is a tuple of length 2, whose entries are the y and
         x pooling sizes.
 
+        `algo` selects the convolution implementation: None lets Theano
+        choose, 'gemm', 'direct' and 'fft' force one (see `convolve`),
+        and 'auto' benchmarks them for this layer's shapes on first use.
+
+        `weights` maps the names of the layer's arrays ('w', 'b') to
+        values used instead of initializing them, as `load_model` does.
+
         """
         self.filter_shape = filter_shape
         self.image_shape = image_shape
         self.poolsize = poolsize
         self.activation_fn = activation_fn
+        self.algo = algo
+        self.set_shapes()
         # initialize weights and biases
         fan_in = filter_shape[1] * np.prod(filter_shape[2:])
         fan_out = filter_shape[0] * np.prod(filter_shape[2:])
         if init=='glorot_uniform':
-            self.w = theano.shared(
-                np.asarray(
-                    np.random.uniform(-0.15, 0.15, size=filter_shape),
-                    dtype=theano.config.floatX),
-                borrow=True)
+            draw = lambda: np.random.uniform(-0.15, 0.15, size=filter_shape)
         if init=='trunc_normal':
-            self.w = theano.shared(
-                np.asarray(
-                    scipy.stats.truncnorm.rvs(-2, 2, loc=0, scale=0.1, size=filter_shape),
-                    dtype=theano.config.floatX),
-                borrow=True)
+            draw = lambda: scipy.stats.truncnorm.rvs(-2, 2, loc=0, scale=0.1, size=filter_shape)
         if init=='normal':
-            self.w = theano.shared(
-                np.asarray(
-                    np.random.normal(
-                        loc=0.0, scale=0.05, size=filter_shape),
-                    dtype=theano.config.floatX),
-                borrow=True)
+            draw = lambda: np.random.normal(loc=0.0, scale=0.05, size=filter_shape)
+        self.w = theano.shared(initial(weights, 'w', draw), borrow=True)
         self.b = theano.shared(
-            np.asarray(
-                np.zeros((filter_shape[0],)),
-                dtype=theano.config.floatX),
+            initial(weights, 'b', lambda: np.zeros((filter_shape[0],))),
             borrow=True)
         self.params = [self.w, self.b]
 
+    def set_shapes(self):
+        "Set the input, convolution and output shapes, and `inner_size`."
+        filter_shape, image_shape = self.filter_shape, self.image_shape
+        self.in_shape = tuple(image_shape)
+        self.conv_shape = (filter_shape[0],
+                           image_shape[1] - filter_shape[2] + 1,
+                           image_shape[2] - filter_shape[3] + 1)
+        self.out_shape = (filter_shape[0],
+                          self.conv_shape[1] // self.poolsize[0],
+                          self.conv_shape[2] // self.poolsize[1])
+        # the convolution output is kept for the max-pooling gradient
+        self.inner_size = int(np.prod(self.conv_shape))
+
+    def __setstate__(self, state):
+        # layers pickled before `algo` existed let Theano choose, and
+        # those pickled before the layers recorded their shapes get them
+        state.setdefault('algo', None)
+        self.__dict__.update(state)
+        if 'in_shape' not in state:
+            self.set_shapes()
+
+    def set_inpt(self, inpt, inpt_dropout, mini_batch_size):
+        shape = tuple([mini_batch_size] + list(self.image_shape))
+        self.inpt = inpt.reshape(shape)
+        conv_out = convolve(self.inpt, self.w, shape, self.filter_shape, self.algo)
+        pooled_out = pool.pool_2d(
+            input=conv_out, ds=self.poolsize, ignore_border=True, mode='max')
+        self.output = self.activation_fn(
+            pooled_out + self.b.dimshuffle('x', 0, 'x', 'x'))
+        self.output_dropout = self.output # no dropout in the convolutional layers
+
+    def flops(self):
+        "Return the forward-pass floating point operations for one example."
+        conv = 2 * np.prod(self.filter_shape[1:]) * np.prod(self.conv_shape)
+        return int(conv + np.prod(self.conv_shape) + 2*np.prod(self.out_shape))
+
+class StridedConvLayer(object):
+    """Used to replace a `ConvPoolLayer` by a single convolution with a
+    stride, which downsamples as the pooling did while computing only
+    the outputs it keeps: a 2x2 stride needs a quarter of the FLOPs of
+    a convolution followed by 2x2 pooling.
+
+    """
+    _init_args = ('filter_shape', 'image_shape', 'stride', 'activation_fn', 'algo')
+
+    def __init__(self, filter_shape, image_shape, stride=(2, 2),
+                 activation_fn=sigmoid, algo=None, weights=None):
+        """`filter_shape`, `image_shape`, `activation_fn`, `algo` and
+        `weights` are as for `ConvPoolLayer`.  `stride` is a tuple of length 2, whose
+        entries are the y and x steps between filter positions.
+
+        """
+        self.filter_shape = filter_shape
+        self.image_shape = image_shape
+        self.stride = stride
+        self.activation_fn = activation_fn
+        self.algo = algo
+        self.in_shape = tuple(image_shape)
+        self.out_shape = (filter_shape[0],
+                          (image_shape[1] - filter_shape[2]) // stride[0] + 1,
+                          (image_shape[2] - filter_shape[3]) // stride[1] + 1)
+        self.inner_size = 0
+        self.w = theano.shared(
+            initial(weights, 'w', lambda: scipy.stats.truncnorm.rvs(
+                -2, 2, loc=0, scale=0.1, size=filter_shape)),
+            borrow=True)
+        self.b = theano.shared(
+            initial(weights, 'b', lambda: np.zeros((filter_shape[0],))), borrow=True)
+        self.params = [self.w, self.b]
+
+    def __setstate__(self, state):
+        # layers pickled before `algo` existed let Theano choose
+        state.setdefault('algo', None)
+        self.__dict__.update(state)
+
+    def set_inpt(self, inpt, inpt_dropout, mini_batch_size):
+        shape = tuple([mini_batch_size] + list(self.image_shape))
+        self.inpt = inpt.reshape(shape)
+        conv_out = convolve(self.inpt, self.w, shape, self.filter_shape, self.algo,
+                            subsample=self.stride)
+        self.output = self.activation_fn(conv_out + self.b.dimshuffle('x', 0, 'x', 'x'))
+        self.output_dropout = self.output # no dropout in the convolutional layers
+
+    def flops(self):
+        "Return the forward-pass floating point operations for one example."
+        conv = 2 * np.prod(self.filter_shape[1:]) * np.prod(self.out_shape)
+        return int(conv + 2*np.prod(self.out_shape))
+
+class SeparableConvPoolLayer(object):
+    """Used in place of a `ConvPoolLayer` with a depthwise-separable
+    convolution: each input feature map is convolved with its own
+    `depth_multiplier` filters, and a 1x1 convolution then mixes the
+    results into the output feature maps, followed by max-pooling.  For
+    C input and F output maps of k x k filters this costs
+    C*M*k*k + F*C*M multiply-adds per pixel instead of F*C*k*k.  The
+    grouped convolution needs Theano 1.0 or later.
+
+    """
+    _init_args = ('filter_shape', 'image_shape', 'poolsize', 'activation_fn',
+                  'depth_multiplier')
+
+    def __init__(self, filter_shape, image_shape, poolsize=(2, 2),
+                 activation_fn=sigmoid, depth_multiplier=1, weights=None):
+        """`filter_shape`, `image_shape`, `poolsize`, `activation_fn` and
+        `weights` are as for `ConvPoolLayer`, which this layer can
+        replace.
+
+        """
+        self.filter_shape = filter_shape
+        self.image_shape = image_shape
+        self.poolsize = poolsize
+        self.activation_fn = activation_fn
+        self.depth_multiplier = depth_multiplier
+        n_out, n_in, fh, fw = filter_shape
+        self.depth_shape = (n_in*depth_multiplier, 1, fh, fw)
+        self.point_shape = (n_out, n_in*depth_multiplier, 1, 1)
+        self.in_shape = tuple(image_shape)
+        self.conv_shape = (n_out, image_shape[1] - fh + 1, image_shape[2] - fw + 1)
+        self.out_shape = (n_out,
+                          self.conv_shape[1] // poolsize[0],
+                          self.conv_shape[2] // poolsize[1])
+        # the depthwise and pointwise outputs are kept for backpropagation
+        self.inner_size = int(np.prod(self.conv_shape[1:])) * (n_in*depth_multiplier + n_out)
+        self.w_depth = theano.shared(
+            initial(weights, 'w_depth', lambda: scipy.stats.truncnorm.rvs(
+                -2, 2, loc=0, scale=0.1, size=self.depth_shape)),
+            borrow=True)
+        self.w = theano.shared(
+            initial(weights, 'w', lambda: np.random.normal(
+                loc=0.0, scale=np.sqrt(2.0/self.point_shape[1]), size=self.point_shape)),
+            borrow=True)
+        self.b = theano.shared(
+            initial(weights, 'b', lambda: np.zeros((n_out,))), borrow=True)
+        self.params = [self.w_depth, self.w, self.b]
+
     def set_inpt(self, inpt, inpt_dropout, mini_batch_size):
         shape = tuple([mini_batch_size] + list(self.image_shape))
         self.inpt = inpt.reshape(shape)
+        depth_out = conv2d(
+            input=self.inpt, filters=self.w_depth, filter_shape=self.depth_shape,
+            input_shape=shape, num_groups=self.image_shape[0])
         conv_out = conv2d(
-            input=self.inpt, filters=self.w, filter_shape=self.filter_shape,
-            input_shape=shape)
+            input=depth_out, filters=self.w, filter_shape=self.point_shape)
         pooled_out = pool.pool_2d(
             input=conv_out, ds=self.poolsize, ignore_border=True, mode='max')
         self.output = self.activation_fn(
             pooled_out + self.b.dimshuffle('x', 0, 'x', 'x'))
         self.output_dropout = self.output # no dropout in the convolutional layers
 
+    def flops(self):
+        "Return the forward-pass floating point operations for one example."
+        pixels = np.prod(self.conv_shape[1:])
+        depth = 2 * np.prod(self.depth_shape) * pixels
+        point = 2 * np.prod(self.point_shape) * pixels
+        return int(depth + point + np.prod(self.conv_shape) + 2*np.prod(self.out_shape))
+
 class FullyConnectedLayer(object):
+    _init_args = ('n_in', 'n_out', 'activation_fn', 'p_dropout')
 
-    def __init__(self, n_in, n_out, activation_fn=sigmoid, p_dropout=0.0):
+    def __init__(self, n_in, n_out, activation_fn=sigmoid, p_dropout=0.0, weights=None):
         self.n_in = n_in
         self.n_out = n_out
         self.activation_fn = activation_fn
         self.p_dropout = p_dropout
+        self.in_shape, self.out_shape = (n_in,), (n_out,)
+        self.inner_size = n_in if p_dropout else 0 # the dropout mask
+        self.dropout_scaling = 'inverted'
         # Initialize weights and biases
         self.w = theano.shared(
-            np.asarray(
-                np.random.normal(
-                    loc=0.0, scale=np.sqrt(2.0/n_in), size=(n_in, n_out)),
-                dtype=theano.config.floatX),
+            initial(weights, 'w', lambda: np.random.normal(
+                loc=0.0, scale=np.sqrt(2.0/n_in), size=(n_in, n_out))),
             name='w', borrow=True)
         self.b = theano.shared(
-            np.zeros((n_out,), dtype=theano.config.floatX),
+            initial(weights, 'b', lambda: np.zeros((n_out,))),
             name='b', borrow=True)
         self.params = [self.w, self.b]
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'in_shape' not in state:
+            # pickled before the layers recorded their shapes
+            self.in_shape, self.out_shape = (self.n_in,), (self.n_out,)
+            self.inner_size = self.n_in if self.p_dropout else 0
+        convert_dropout(self)
+
     def set_inpt(self, inpt, inpt_dropout, mini_batch_size):
         self.inpt = inpt.reshape((mini_batch_size, self.n_in))
         self.output = self.activation_fn(
-            (1-self.p_dropout)*T.dot(self.inpt, self.w) + self.b)
+            T.dot(self.inpt, self.w) + self.b)
         self.y_out = T.argmax(self.output, axis=1)
         self.inpt_dropout = dropout_layer(
             inpt_dropout.reshape((mini_batch_size, self.n_in)), self.p_dropout)
         self.output_dropout = self.activation_fn(
             T.dot(self.inpt_dropout, self.w) + self.b)
 
+    def flops(self):
+        "Return the forward-pass floating point operations for one example."
+        return 2*self.n_in*self.n_out + 2*self.n_out
+
     def accuracy(self, y):
         "Return the accuracy for the mini-batch."
         return T.mean(T.eq(y, self.y_out))
 
 class SoftmaxLayer(object):
+    _init_args = ('n_in', 'n_out', 'p_dropout')
 
-    def __init__(self, n_in, n_out, p_dropout=0.0):
+    def __init__(self, n_in, n_out, p_dropout=0.0, weights=None):
         self.n_in = n_in
         self.n_out = n_out
         self.p_dropout = p_dropout
+        self.in_shape, self.out_shape = (n_in,), (n_out,)
+        self.inner_size = n_in if p_dropout else 0 # the dropout mask
+        self.dropout_scaling = 'inverted'
         # Initialize weights and biases
         self.w = theano.shared(
-            np.zeros((n_in, n_out), dtype=theano.config.floatX),
+            initial(weights, 'w', lambda: np.zeros((n_in, n_out))),
             name='w', borrow=True)
         self.b = theano.shared(
-            np.zeros((n_out,), dtype=theano.config.floatX),
+            initial(weights, 'b', lambda: np.zeros((n_out,))),
             name='b', borrow=True)
         self.params = [self.w, self.b]
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'in_shape' not in state:
+            # pickled before the layers recorded their shapes
+            self.in_shape, self.out_shape = (self.n_in,), (self.n_out,)
+            self.inner_size = self.n_in if self.p_dropout else 0
+        convert_dropout(self)
+
     def set_inpt(self, inpt, inpt_dropout, mini_batch_size):
         self.inpt = inpt.reshape((mini_batch_size, self.n_in))
-        self.output = softmax((1-self.p_dropout)*T.dot(self.inpt, self.w) + self.b)
+        self.output = softmax(T.dot(self.inpt, self.w) + self.b)
         self.y_out = T.argmax(self.output, axis=1)
         self.inpt_dropout = dropout_layer(
             inpt_dropout.reshape((mini_batch_size, self.n_in)), self.p_dropout)
         self.output_dropout = softmax(T.dot(self.inpt_dropout, self.w) + self.b)
 
+    def flops(self):
+        "Return the forward-pass floating point operations for one example."
+        return 2*self.n_in*self.n_out + 4*self.n_out
+
     def cost(self, net):
         "Return the log-likelihood cost."
-        return -T.mean(T.log(self.output_dropout)[T.arange(net.y.shape[0]), net.y])
+        return T.mean(self.example_costs(net))
+
+    def example_costs(self, net, dropout=True):
+        """Return the log-likelihood cost of each example of the mini-batch,
+        through the dropout path unless `dropout` is false."""
+        output = self.output_dropout if dropout else self.output
+        return -T.log(output)[T.arange(net.y.shape[0]), net.y]
 
     def accuracy(self, y):
         "Return the accuracy for the mini-batch."
         return T.mean(T.eq(y, self.y_out))
 
 
+class BatchNormLayer(object):
+    """Used to normalize the output of the preceding layer with the mean
+    and variance of each mini-batch (see https://arxiv.org/abs/1502.03167),
+    followed by a learned scale `gamma`, shift `beta` and `activation_fn`.
+    At inference time the running averages of those statistics are used
+    instead.
+
+    The preceding `ConvPoolLayer` or `FullyConnectedLayer` should be
+    built with `activation_fn=linear`, so that the layer can later be
+    folded into its weights by `Network.fold_batch_norm`.
+
+    """
+    _init_args = ('shape', 'activation_fn', 'momentum', 'epsilon')
+
+    def __init__(self, shape, activation_fn=linear, momentum=0.9, epsilon=1e-5,
+                 weights=None):
+        """`shape` is the shape of a single input example: `(n_in,)` after
+        a fully connected layer, or a tuple of the number of feature
+        maps, the height and the width after a convolutional layer.
+        Statistics are kept per unit in the first case and per feature
+        map in the second.
+
+        `momentum` is the decay of the running averages of the mean and
+        variance.  `weights` is as for `ConvPoolLayer`.
+
+        """
+        self.shape = tuple(shape)
+        self.in_shape = self.out_shape = self.shape
+        self.inner_size = int(np.prod(self.shape)) # the normalized input
+        self.activation_fn = activation_fn
+        self.momentum = momentum
+        self.epsilon = epsilon
+        n = self.shape[0]
+        self.gamma = theano.shared(
+            initial(weights, 'gamma', lambda: np.ones((n,))), name='gamma', borrow=True)
+        self.beta = theano.shared(
+            initial(weights, 'beta', lambda: np.zeros((n,))), name='beta', borrow=True)
+        self.running_mean = theano.shared(
+            initial(weights, 'running_mean', lambda: np.zeros((n,))),
+            name='running_mean', borrow=True)
+        self.running_var = theano.shared(
+            initial(weights, 'running_var', lambda: np.ones((n,))),
+            name='running_var', borrow=True)
+        self.params = [self.gamma, self.beta]
+        self.stats = [self.running_mean, self.running_var]
+
+    def set_inpt(self, inpt, inpt_dropout, mini_batch_size):
+        shape = tuple([mini_batch_size] + list(self.shape))
+        if len(self.shape) == 1:
+            axes, pattern = (0,), ('x', 0)
+        else:
+            axes, pattern = (0, 2, 3), ('x', 0, 'x', 'x')
+        self.inpt = inpt.reshape(shape)
+        self.inpt_dropout = inpt_dropout.reshape(shape)
+        mean = self.inpt_dropout.mean(axis=axes)
+        var = self.inpt_dropout.var(axis=axes)
+        self.output = self.activation_fn(self.normalize(
+            self.inpt, self.running_mean, self.running_var, pattern))
+        self.output_dropout = self.activation_fn(self.normalize(
+            self.inpt_dropout, mean, var, pattern))
+        # the running variance is kept unbiased
+        n = mini_batch_size * np.prod(self.shape[1:])
+        self.updates = [
+            (self.running_mean,
+             self.momentum*self.running_mean + (1-self.momentum)*mean),
+            (self.running_var,
+             self.momentum*self.running_var + (1-self.momentum)*var*n/max(n-1, 1))]
+
+    def flops(self):
+        "Return the forward-pass floating point operations for one example."
+        return 4*int(np.prod(self.shape))
+
+    def normalize(self, z, mean, var, pattern):
+        scale = self.gamma / T.sqrt(var + self.epsilon)
+        shift = self.beta - mean*scale
+        return z*scale.dimshuffle(*pattern) + shift.dimshuffle(*pattern)
+
+    def fold_into(self, layer):
+        """Fold the normalization into the `w` and `b` of `layer`, which
+        must be the convolutional or fully connected layer preceding
+        this one, and hand it the activation function.
+
+        """
+        if layer.activation_fn is not linear:
+            raise ValueError("Only a layer with a linear activation can absorb batch normalization.")
+        scale = self.gamma.get_value() / np.sqrt(self.running_var.get_value() + self.epsilon)
+        shift = self.beta.get_value() - self.running_mean.get_value()*scale
+        if isinstance(layer, (ConvPoolLayer, SeparableConvPoolLayer, StridedConvLayer)):
+            # max-pooling commutes with the scale only when it is non-negative
+            if hasattr(layer, 'poolsize') and np.any(scale < 0):
+                raise ValueError("Cannot fold a negative scale through max-pooling.")
+            w = layer.w.get_value() * scale[:, None, None, None]
+        elif isinstance(layer, FullyConnectedLayer):
+            w = layer.w.get_value() * scale
+        else:
+            raise TypeError("Cannot fold batch normalization into {0}.".format(
+                type(layer).__name__))
+        layer.w.set_value(np.asarray(w, dtype=theano.config.floatX))
+        layer.b.set_value(np.asarray(
+            layer.b.get_value()*scale + shift, dtype=theano.config.floatX))
+        layer.activation_fn = self.activation_fn
+
+
 #### Helper functions
+class SumTree(object):
+    """Used to draw indices with probability proportional to non-negative
+    scores that change a few at a time.  The scores are the leaves of a
+    binary tree whose inner nodes hold the sums of their children, so
+    drawing or updating k of n scores costs O(k log n) instead of the
+    O(n) of renormalizing them all.
+
+    """
+
+    def __init__(self, scores):
+        self.n = len(scores)
+        self.leaves = 1
+        while self.leaves < self.n:
+            self.leaves *= 2
+        self.tree = np.zeros(2*self.leaves)
+        self.update(np.arange(self.n), scores)
+
+    def __getitem__(self, indices):
+        return self.tree[np.asarray(indices) + self.leaves]
+
+    def total(self):
+        "Return the sum of the scores."
+        return self.tree[1]
+
+    def update(self, indices, scores):
+        "Set the scores of `indices`, and the sums above them."
+        nodes = np.asarray(indices) + self.leaves
+        self.tree[nodes] = scores
+        while self.leaves > 1:
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2*nodes] + self.tree[2*nodes+1]
+            if nodes[0] == 1:
+                break
+
+    def sample(self, k):
+        "Return `k` indices drawn with replacement in proportion to their scores."
+        targets = np.random.uniform(0, self.total(), size=k)
+        nodes = np.ones(k, dtype=np.int64)
+        while nodes[0] < self.leaves:
+            left = 2*nodes
+            right = targets >= self.tree[left]
+            targets -= self.tree[left]*right
+            nodes = left + right
+        # rounding can step past the last score
+        return np.minimum(nodes - self.leaves, self.n - 1)
+
+conv_algo_cache = {} # (input shape, filter shape, subsample): fastest algorithm
+
+def shared(data):
+    """Place the data into shared variables, the images in the storage
+    dtype of the precision policy.  This allows Theano to copy the data
+    to the GPU, if one is available.
+
+    """
+    shared_x = theano.shared(
+        np.asarray(data[0], dtype=STORAGE_DTYPE), borrow=True)
+    shared_y = theano.shared(
+        np.asarray(data[1], dtype='int32'), borrow=True)
+    return shared_x, shared_y
+
 def size(data):
     "Return the number of samples of the dataset `data`."
     return data[0].get_value(borrow=True).shape[0]
 
+# layer types whose weights `stacked_forward` can stack
+STACKABLE = (ConvPoolLayer, FullyConnectedLayer, SoftmaxLayer)
+
+def stack_weights(layers):
+    """Return shared variables holding the weights `w` and the biases `b`
+    of `layers`, stacked along a new leading axis."""
+    return (theano.shared(np.stack([layer.w.get_value() for layer in layers]), borrow=True),
+            theano.shared(np.stack([layer.b.get_value() for layer in layers]), borrow=True))
+
+def stacked_forward(members, stacked, x, mini_batch_size, dropout=False):
+    """Return the symbolic (networks, batch, units) outputs of K networks
+    of identical layer shapes, all given the mini-batch `x`.
+    `members[j]` lists the K networks' layer j.  Where `stacked[j]` holds
+    their weights stacked by `stack_weights`, the K layers run together:
+    a `ConvPoolLayer` as a single convolution with K groups, a dense or
+    softmax layer as a batched matrix product.  Other layers run member
+    by member.  The stacked dense layers apply dropout if `dropout` is
+    true.
+
+    """
+    K, B = len(members[0]), mini_batch_size
+    # the input is 'shared' by all networks, 'grouped' as (batch,
+    # networks*maps, height, width), 'stacked' as (networks, batch,
+    # units), or a 'list' with one tensor per network
+    inpt, layout = x, 'shared'
+    for layers, weights in zip(members, stacked):
+        layer = layers[0]
+        if weights is None:
+            if layout == 'shared':
+                inpt = [inpt] * K
+            elif layout == 'grouped':
+                C = layer.in_shape[0]
+                inpt = [inpt[:, k*C:(k+1)*C] for k in xrange(K)]
+            elif layout == 'stacked':
+                inpt = [inpt[k] for k in xrange(K)]
+            outputs = []
+            for member, h in zip(layers, inpt):
+                member.set_inpt(h, h, B)
+                outputs.append(member.output_dropout if dropout else member.output)
+            inpt, layout = outputs, 'list'
+        elif isinstance(layer, ConvPoolLayer):
+            w, b = weights
+            F, C, fh, fw = layer.filter_shape
+            filter_shape = (K*F, C, fh, fw)
+            if layout == 'shared':
+                input_shape = (B,) + layer.in_shape
+                conv_out = conv2d(
+                    input=inpt.reshape(input_shape), filters=w.reshape(filter_shape),
+                    filter_shape=filter_shape, input_shape=input_shape)
+            else:
+                input_shape = (B, K*C) + layer.in_shape[1:]
+                if layout == 'list':
+                    inpt = T.concatenate([h.reshape((B,) + layer.in_shape) for h in inpt],
+                                         axis=1)
+                elif layout == 'stacked':
+                    inpt = inpt.dimshuffle(1, 0, 2)
+                conv_out = conv2d(
+                    input=inpt.reshape(input_shape), filters=w.reshape(filter_shape),
+                    filter_shape=filter_shape, input_shape=input_shape, num_groups=K)
+            pooled_out = pool.pool_2d(
+                input=conv_out, ds=layer.poolsize, ignore_border=True, mode='max')
+            inpt = layer.activation_fn(
+                pooled_out + b.reshape((K*F,)).dimshuffle('x', 0, 'x', 'x'))
+            layout = 'grouped'
+        else:
+            w, b = weights
+            n_in, n_out = layer.n_in, layer.n_out
+            if layout == 'grouped':
+                inpt = inpt.reshape((B, K, n_in)).dimshuffle(1, 0, 2)
+            elif layout == 'list':
+                inpt = T.stack([h.reshape((B, n_in)) for h in inpt])
+            elif layout == 'shared' and dropout and layer.p_dropout:
+                # each network draws its own masks
+                inpt = T.alloc(inpt.reshape((B, n_in)), K, B, n_in)
+                layout = 'stacked'
+            if dropout:
+                inpt = dropout_layer(inpt, layer.p_dropout)
+            if layout == 'shared':
+                # all networks share the input: one wide product
+                z = T.dot(inpt.reshape((B, n_in)),
+                          w.dimshuffle(1, 0, 2).reshape((n_in, K*n_out)))
+                z = z.reshape((B, K, n_out)).dimshuffle(1, 0, 2)
+            else:
+                z = T.batched_dot(inpt, w)
+            z = z + b.dimshuffle(0, 'x', 1)
+            if isinstance(layer, SoftmaxLayer):
+                inpt = softmax(z.reshape((K*B, n_out))).reshape((K, B, n_out))
+            else:
+                inpt = layer.activation_fn(z)
+            layout = 'stacked'
+    if layout == 'list':
+        inpt = T.stack([h.reshape((B, -1)) for h in inpt])
+    return inpt
+
+def layer_signature(layer):
+    """Return what must agree between the layers of networks whose
+    weights are stacked: the type, shapes, pooling, activation function
+    and dropout of `layer`."""
+    return (type(layer), layer.in_shape, layer.out_shape,
+            getattr(layer, 'poolsize', None),
+            getattr(layer, 'activation_fn', None),
+            getattr(layer, 'p_dropout', 0))
+
+def shared_attributes(layer):
+    """Return the sorted (name, variable) pairs of the Theano shared
+    variables held by `layer`: its parameters and any statistics."""
+    return [(name, value) for name, value in sorted(vars(layer).items())
+            if isinstance(value, theano.compile.SharedVariable)]
+
+def initial(weights, name, draw):
+    """Return the initial value of a layer's array `name`: `weights[name]`
+    as given, or else `draw()` in floatX, so that no initialization runs
+    for the arrays that are supplied."""
+    if weights is not None and name in weights:
+        return weights[name]
+    return np.asarray(draw(), dtype=theano.config.floatX)
+
+def load_model(filename):
+    """Load a net written by `Network.export`.  The weights are not
+    read but memory-mapped read-only, and given to the layers in place
+    of their initialization, so loading is immediate, leaves
+    `np.random` untouched, and processes loading the same model share
+    the physical pages.
+
+    """
+    with open(filename + '.json') as f:
+        desc = json.load(f)
+    layer_types = dict([(cls.__name__, cls) for cls in
+                        [ConvPoolLayer, StridedConvLayer, SeparableConvPoolLayer,
+                         FullyConnectedLayer, SoftmaxLayer, BatchNormLayer]])
+    layers = []
+    for spec in desc['layers']:
+        args = {}
+        for name, value in spec['args'].items():
+            if name == 'activation_fn':
+                value = ACTIVATIONS[value]
+            elif isinstance(value, list):
+                value = tuple(value)
+            args[str(name)] = value
+        weights = {}
+        for array in spec['arrays']:
+            weights[str(array['name'])] = np.memmap(
+                filename + '.weights', dtype=np.dtype(str(array['dtype'])),
+                mode='r', offset=array['offset'], shape=tuple(array['shape']))
+        if desc.get('dropout_scaling') != 'inverted' and args.get('p_dropout'):
+            # exported before dropout was inverted: rescaled in a copy,
+            # as the map is read-only
+            weights['w'] = np.asarray(weights['w'] * (1-args['p_dropout']),
+                                      dtype=weights['w'].dtype)
+            print("Rescaled the weights of a {0} exported before inverted dropout.".format(
+                spec['type']))
+        layers.append(layer_types[spec['type']](weights=weights, **args))
+    return Network(layers)
+
+def convolve(inpt, filters, input_shape, filter_shape, algo=None, subsample=(1, 1)):
+    """Return the valid convolution of `inpt` with `filters`, computed by
+    `algo`: 'gemm' lowers it to a matrix product over unrolled image
+    patches (im2col), 'direct' loops over the filter positions, 'fft'
+    multiplies Fourier transforms, and 'auto' picks the fastest of
+    those for the shapes with `tune_conv`.  None leaves the choice to
+    Theano's optimizer, as `conv2d` does.
+
+    """
+    if algo == 'auto':
+        algo = tune_conv(input_shape, filter_shape, subsample)
+    if algo is None:
+        return conv2d(input=inpt, filters=filters, filter_shape=filter_shape,
+                      input_shape=input_shape, subsample=subsample)
+    if algo == 'gemm':
+        # CorrMM correlates, so the filters are flipped to convolve
+        return CorrMM(subsample=subsample)(inpt, filters[:, :, ::-1, ::-1])
+    if algo == 'direct':
+        return legacy_conv.conv2d(inpt, filters, image_shape=input_shape,
+                                  filter_shape=filter_shape, subsample=subsample)
+    if algo == 'fft':
+        return fft_conv2d(inpt, filters, input_shape, filter_shape, subsample)
+    raise ValueError("Unknown convolution algorithm {0}.".format(algo))
+
+def fft_conv2d(inpt, filters, input_shape, filter_shape, subsample=(1, 1)):
+    """Return the valid convolution of `inpt` with `filters` through the
+    FFT: the filters are zero-padded to the image size, so the circular
+    convolution equals the valid one away from the borders, which are
+    then cropped."""
+    n, c, h, w = input_shape
+    f, _, fh, fw = filter_shape
+    padded = T.zeros((f*c, h, w), dtype=filters.dtype)
+    padded = T.set_subtensor(padded[:, :fh, :fw], filters.reshape((f*c, fh, fw)))
+    x = fft.rfft(inpt.reshape((n*c, h, w))).reshape((n, 1, c, h, w//2+1, 2))
+    k = fft.rfft(padded).reshape((1, f, c, h, w//2+1, 2))
+    # complex products, summed over the input feature maps
+    xr, xi = x[:, :, :, :, :, 0], x[:, :, :, :, :, 1]
+    kr, ki = k[:, :, :, :, :, 0], k[:, :, :, :, :, 1]
+    real = (xr*kr - xi*ki).sum(axis=2)
+    imag = (xr*ki + xi*kr).sum(axis=2)
+    y = fft.irfft(T.stack([real, imag], axis=-1).reshape((n*f, h, w//2+1, 2)),
+                  is_odd=(w % 2 == 1)).reshape((n, f, h, w))
+    return y[:, :, fh-1::subsample[0], fw-1::subsample[1]]
+
+def tune_conv(input_shape, filter_shape, subsample=(1, 1), n_iter=5):
+    """Return the fastest convolution algorithm, forward and backward,
+    for the shapes.  Each shape is benchmarked once per process, on at
+    most 128 examples, and the winner is kept in `conv_algo_cache`.
+
+    """
+    input_shape = (min(input_shape[0], 128),) + tuple(input_shape[1:])
+    key = (input_shape, tuple(filter_shape), tuple(subsample))
+    if key not in conv_algo_cache:
+        x = np.asarray(np.random.normal(size=input_shape), dtype=theano.config.floatX)
+        filters = theano.shared(np.asarray(
+            np.random.normal(size=filter_shape), dtype=theano.config.floatX))
+        inpt = T.tensor4()
+        times = {}
+        for algo in ['gemm', 'direct', 'fft']:
+            out = convolve(inpt, filters, input_shape, filter_shape, algo, subsample)
+            fn = theano.function([inpt], T.grad(out.sum(), [inpt, filters]))
+            times[algo] = np.median(time_fn(fn, [x], n_iter))
+        conv_algo_cache[key] = min(times, key=times.get)
+        print("Convolution {0}: {1} ({2})".format(key, conv_algo_cache[key], ", ".join(
+            ["{0} {1:.2f} ms".format(algo, 1e3*t) for algo, t in sorted(times.items())])))
+    return conv_algo_cache[key]
+
+def recompute_layer(layer, inpt, inpt_dropout, mini_batch_size):
+    """Replace the training-path output of `layer`, already set from
+    `inpt` and `inpt_dropout`, by a single op computing it from the
+    layer's input and parameters.  The gradient of that op recomputes
+    the layer's intermediate values, such as the convolution output
+    before pooling, instead of keeping them from the forward pass."""
+    x = inpt_dropout.type()
+    params = [param.type() for param in layer.params]
+    layer.set_inpt(x, x, mini_batch_size)
+    inner = theano.clone(layer.output_dropout, replace=dict(zip(layer.params, params)))
+    op = theano.OpFromGraph([x] + params, [inner], inline=False)
+    layer.set_inpt(inpt, inpt_dropout, mini_batch_size)
+    layer.output_dropout = op(inpt_dropout, *layer.params)
+
+def time_fn(fn, args, n_iter):
+    """Call the compiled function `fn` once to warm it up, then `n_iter`
+    times, and return the list of wall times in seconds."""
+    fn(*args)
+    times = []
+    for _ in xrange(n_iter):
+        t0 = time()
+        fn(*args)
+        times.append(time() - t0)
+    return times
+
+def time_layer(layer, mini_batch_size, n_iter, optim_mode='gd', eta=0.1):
+    """Time `layer` alone on a random mini-batch, and return a dict of
+    lists of `n_iter` wall times in seconds: 'forward' for the training
+    path forward pass, 'backward' for the forward pass and the
+    gradients, and 'update' for those and the parameter update of
+    `optim_mode` ('gd' or 'adam').  The layer's parameters are updated
+    in place.
+
+    """
+    shape = (mini_batch_size,) + layer.in_shape
+    inpt = T.TensorType(theano.config.floatX, (False,)*len(shape))()
+    layer.set_inpt(inpt, inpt, mini_batch_size)
+    out = layer.output_dropout
+    x = np.asarray(np.random.normal(size=shape), dtype=theano.config.floatX)
+    # a fixed random gradient flowing back from the next layer
+    g = theano.shared(np.asarray(
+        np.random.normal(size=(mini_batch_size,) + layer.out_shape),
+        dtype=theano.config.floatX))
+    surrogate = (out.reshape(g.shape) * g).sum()
+    forward = theano.function([inpt], out)
+    backward = theano.function([inpt], T.grad(surrogate, [inpt] + layer.params))
+    if optim_mode=='adam':
+        updates = Adam(surrogate, layer.params)
+    else:
+        updates = [(param, param-eta*grad) for param, grad in
+                   zip(layer.params, T.grad(surrogate, layer.params))]
+    update = theano.function([inpt], [], updates=updates, on_unused_input='ignore')
+    return {'forward': time_fn(forward, [x], n_iter),
+            'backward': time_fn(backward, [x], n_iter),
+            'update': time_fn(update, [x], n_iter)}
+
+def profile_table(report):
+    "Format a report returned by `Network.profile` as a text table."
+    header = "{0:<24}{1:>10}{2:>10}{3:>10}{4:>12}{5:>10}{6:>10}{7:>12}{8:>12}".format(
+        "layer", "fwd ms", "bwd ms", "upd ms", "fwd MFLOP", "fwd GF/s",
+        "bwd GF/s", "param KB", "act KB")
+    lines = [header, "-"*len(header)]
+    for row in report:
+        lines.append(
+            "{0:<24}{1:>10.3f}{2:>10.3f}{3:>10.3f}{4:>12.2f}{5:>10.2f}{6:>10.2f}{7:>12.1f}{8:>12.1f}".format(
+                row['layer'], 1e3*row['forward_s'], 1e3*row['backward_s'],
+                1e3*row['update_s'], row['forward_flops']/1e6,
+                row['forward_gflops_per_s'], row['backward_gflops_per_s'],
+                row['param_bytes']/1024., row['activation_bytes']/1024.))
+    return "\n".join(lines)
+
+def convert_dropout(layer):
+    """Rescale the weights of a dense or softmax `layer` pickled before
+    dropout was inverted, whose inference path multiplied them by
+    (1-p_dropout), so that it predicts as it did.  Layers carrying the
+    'inverted' `dropout_scaling` marker are left alone."""
+    if getattr(layer, 'dropout_scaling', None) == 'inverted':
+        return
+    if layer.p_dropout:
+        w = layer.w.get_value()
+        layer.w.set_value(np.asarray(w * (1-layer.p_dropout), dtype=w.dtype))
+        print("Rescaled the weights of a {0} saved before inverted dropout.".format(
+            type(layer).__name__))
+    layer.dropout_scaling = 'inverted'
+
 def dropout_layer(layer, p_dropout):
-    srng = shared_randomstreams.RandomStreams(
-        np.random.RandomState(0).randint(999999))
-    mask = srng.binomial(n=1, p=1-p_dropout, size=layer.shape)
-    return layer*T.cast(mask, theano.config.floatX)
+    """Zero each unit of `layer` with probability `p_dropout` and scale
+    the others by 1/(1-p_dropout) (inverted dropout), so that the
+    inference path needs no rescaling.  The mask is a threshold on one
+    uniform draw per unit from the shared stream `srng`."""
+    if p_dropout == 0:
+        return layer
+    keep = srng.uniform(size=layer.shape, dtype=theano.config.floatX) >= p_dropout
+    return layer*T.cast(keep, theano.config.floatX)/(1-p_dropout)
+
+def optimizer_updates(cost, params, optim_mode, eta, lr_scale=1.0):
+    """Return the updates of `params` minimizing `cost` for `optim_mode`,
+    with the learning rate multiplied by `lr_scale`.  'adam' keeps its
+    own base learning rate; 'gd', 'lars' and 'lamb' use `eta`."""
+    if optim_mode=='gd':
+        grads = T.grad(cost, params)
+        return [(param, param-eta*lr_scale*grad)
+                for param, grad in zip(params, grads)]
+    if optim_mode=='adam':
+        return Adam(cost, params, lr=0.001*lr_scale)
+    if optim_mode=='lars':
+        return LARS(cost, params, lr=eta*lr_scale)
+    if optim_mode=='lamb':
+        return LAMB(cost, params, lr=eta*lr_scale)
+    raise ValueError("Unknown optim_mode {0}.".format(optim_mode))
+
+def lr_schedule(iteration, total, warmup, decay=None):
+    """Return the learning rate multiplier at `iteration`, counted from 0,
+    of `total`: a linear warmup over the first `warmup` iterations, then
+    a `decay` of None (constant), 'linear' or 'cosine' to zero."""
+    if iteration < warmup:
+        return float(iteration + 1) / warmup
+    progress = float(iteration - warmup) / max(total - warmup, 1)
+    if decay == 'linear':
+        return 1.0 - progress
+    if decay == 'cosine':
+        return 0.5 * (1 + np.cos(np.pi * progress))
+    return 1.0
+
+def trust_ratio(param, update, trust=1.0, e=1e-8):
+    """Return the layer-wise scale trust * ||param|| / ||update|| of LARS
+    and LAMB for a weight matrix, or 1 -- a plain step -- for biases and
+    while either norm is 0."""
+    if param.ndim < 2:
+        return 1.0
+    w_norm, u_norm = param.norm(2), update.norm(2)
+    return T.switch(T.gt(w_norm, 0) * T.gt(u_norm, 0), trust * w_norm / (u_norm + e), 1.0)
+
+def LARS(cost, params, lr, momentum=0.9, trust=0.001):
+    # see the paper https://arxiv.org/abs/1708.03888
+    updates = []
+    grads = T.grad(cost, params)
+    for param, grad in zip(params, grads):
+        v = theano.shared(np.zeros(param.get_value().shape, dtype=theano.config.floatX))
+        v_t = momentum*v + lr*trust_ratio(param, grad, trust)*grad
+        updates.append((v, v_t))
+        updates.append((param, param - v_t))
+    return updates
+
+def LAMB(cost, params, lr, beta1=0.9, beta2=0.999, e=1e-6):
+    # see the paper https://arxiv.org/abs/1904.00962
+    updates = []
+    grads = T.grad(cost, params)
+    t = theano.shared(np.asarray(1, dtype=theano.config.floatX))
+    for param, grad in zip(params, grads):
+        m = theano.shared(np.zeros(param.get_value().shape, dtype=theano.config.floatX))
+        v = theano.shared(np.zeros(param.get_value().shape, dtype=theano.config.floatX))
+        m_t = ((1 - beta1) * grad) + (beta1 * m)
+        v_t = ((1 - beta2) * T.sqr(grad)) + (beta2 * v)
+        r_t = (m_t / (1 - beta1**t)) / (T.sqrt(v_t / (1 - beta2**t)) + e)
+        updates.append((m, m_t))
+        updates.append((v, v_t))
+        updates.append((param, param - lr*trust_ratio(param, r_t)*r_t))
+    updates.append((t, t+1))
+    return updates
 
 def Adam(cost, params, lr=0.001, beta1=0.9, beta2=0.999, e=1e-8):
     # see the paper https://arxiv.org/abs/1412.6980
     updates = []
     grads = T.grad(cost, params)
-    t = theano.shared(np.float32(1))
+    t = theano.shared(np.asarray(1, dtype=theano.config.floatX))
     lr_t = lr * T.sqrt(1 - beta2**t)/(1 - beta1**t)
     e_hat = e * T.sqrt(1 - beta2**t)
     for param, grad in zip(params, grads):
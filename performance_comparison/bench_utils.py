@@ -0,0 +1,44 @@
+## Helpers shared by the convnet benchmarks of this directory: the
+## ConvNet they measure, synthetic data, and time to a target accuracy
+
+## Libraries
+# Third-party libraries
+import numpy as np
+import convnet as cn
+
+
+def conv_layers():
+    "Return the two ConvPoolLayers of the ConvNet of th_test.py (experiment 5)."
+    return [cn.ConvPoolLayer(image_shape=(1, 28, 28),
+                          filter_shape=(16, 1, 5, 5),
+                          poolsize=(2, 2),
+                          activation_fn=cn.ReLU),
+            cn.ConvPoolLayer(image_shape=(16, 12, 12),
+                          filter_shape=(32, 16, 5, 5),
+                          poolsize=(2, 2),
+                          activation_fn=cn.ReLU)]
+
+def build_net(p_dropout=0.5, convs=None):
+    """Return a fresh ConvNet of th_test.py (experiment 5), with dropout
+    `p_dropout` in its dense layers.  `convs` replaces its two conv
+    layers by others of the same output shape."""
+    return cn.Network((convs or conv_layers()) + [
+        cn.FullyConnectedLayer(n_in=32*4*4, n_out=128,
+                      activation_fn=cn.ReLU, p_dropout=p_dropout),
+        cn.FullyConnectedLayer(n_in=128, n_out=128,
+                      activation_fn=cn.ReLU, p_dropout=p_dropout),
+        cn.SoftmaxLayer(n_in=128, n_out=10)])
+
+def synthetic_data(n):
+    """Return `n` random images and labels in shared variables, for the
+    benchmarks whose timings do not depend on the values."""
+    return cn.shared((np.random.uniform(size=(n, 784)), np.random.randint(10, size=n)))
+
+def time_to_target(net, target_accuracy):
+    """Return the seconds of training until the validation accuracy in
+    `net.history` first reached `target_accuracy`, or None if it never
+    did."""
+    for epoch, elapsed, accuracy in net.history:
+        if accuracy >= target_accuracy:
+            return elapsed
+    return None
@@ -0,0 +1,68 @@
+## Convergence of the ConvNet with and without batch normalization,
+## in wall time to a target validation accuracy
+
+## Libraries
+# Third-party libraries
+import pandas as pd
+import numpy as np
+import convnet as cn
+import bench_utils as bu
+
+
+## Read data from CSV file
+train = pd.read_csv("./convnet_MNIST/train.csv").values
+
+## Setting features and labels
+Xval, yval = train[20000:25000,1:], train[20000:25000,0]
+X, y = train[:20000,1:], train[:20000,0]
+Xval = Xval / 255.
+X = X / 255.
+del train
+
+train_data, valid_data = cn.shared((X, y)), cn.shared((Xval, yval))
+del X, Xval, y, yval
+
+target_accuracy = 0.985
+
+
+### Baseline: experiment 5 of th_test.py
+num_epochs = 15
+net = bu.build_net()
+net.fit(train_data, num_epochs, 32, 0.05, valid_data, lmbda=0.005, optim_mode='adam')
+base_time = bu.time_to_target(net, target_accuracy)
+
+
+### Batch normalization after each conv and dense layer,
+### with a 4x larger mini-batch and a higher learning rate
+net = cn.Network([
+    cn.ConvPoolLayer(image_shape=(1, 28, 28),
+                  filter_shape=(16, 1, 5, 5),
+                  poolsize=(2, 2),
+                  activation_fn=cn.linear),
+    cn.BatchNormLayer((16, 12, 12), activation_fn=cn.ReLU),
+    cn.ConvPoolLayer(image_shape=(16, 12, 12),
+                  filter_shape=(32, 16, 5, 5),
+                  poolsize=(2, 2),
+                  activation_fn=cn.linear),
+    cn.BatchNormLayer((32, 4, 4), activation_fn=cn.ReLU),
+    cn.FullyConnectedLayer(n_in=32*4*4, n_out=128,
+                  activation_fn=cn.linear),
+    cn.BatchNormLayer((128,), activation_fn=cn.ReLU),
+    cn.FullyConnectedLayer(n_in=128, n_out=128,
+                  activation_fn=cn.linear),
+    cn.BatchNormLayer((128,), activation_fn=cn.ReLU),
+    cn.SoftmaxLayer(n_in=128, n_out=10)])
+net.fit(train_data, num_epochs, 128, 0.2, valid_data, lmbda=0.005)
+bn_time = bu.time_to_target(net, target_accuracy)
+
+print "\nSeconds to {0:.1%} validation accuracy".format(target_accuracy)
+print "  baseline (adam, mini-batch 32):", base_time
+print "  batch norm (gd, mini-batch 128):", bn_time
+
+
+### Folding into the conv/dense weights must not change the predictions
+pred_bn = net.predict(valid_data[0])
+net.fold_batch_norm()
+pred_folded = net.predict(valid_data[0])
+print "Layers after folding:", [type(layer).__name__ for layer in net.layers]
+print "Predictions unchanged by folding:", np.mean(pred_bn == pred_folded)
@@ -0,0 +1,41 @@
+## Speed of the ConvNet of th_cnn_mnist.py (experiment 2) with the
+## convolution algorithm autotuned, and with cheaper conv layer types
+
+## Libraries
+import convnet as cn
+import bench_utils as bu
+
+
+mini_batch_size = 16
+
+variants = [
+    ('conv+pool (baseline)', lambda: bu.build_net()),
+    ('conv+pool, autotuned', lambda: bu.build_net(convs=[
+        cn.ConvPoolLayer(image_shape=(1, 28, 28), filter_shape=(16, 1, 5, 5),
+                      poolsize=(2, 2), activation_fn=cn.ReLU, algo='auto'),
+        cn.ConvPoolLayer(image_shape=(16, 12, 12), filter_shape=(32, 16, 5, 5),
+                      poolsize=(2, 2), activation_fn=cn.ReLU, algo='auto')])),
+    ('separable second layer', lambda: bu.build_net(convs=[
+        cn.ConvPoolLayer(image_shape=(1, 28, 28), filter_shape=(16, 1, 5, 5),
+                      poolsize=(2, 2), activation_fn=cn.ReLU),
+        cn.SeparableConvPoolLayer(image_shape=(16, 12, 12), filter_shape=(32, 16, 5, 5),
+                      poolsize=(2, 2), activation_fn=cn.ReLU)])),
+    ('strided conv', lambda: bu.build_net(convs=[
+        cn.StridedConvLayer(image_shape=(1, 28, 28), filter_shape=(16, 1, 5, 5),
+                      stride=(2, 2), activation_fn=cn.ReLU),
+        cn.StridedConvLayer(image_shape=(16, 12, 12), filter_shape=(32, 16, 5, 5),
+                      stride=(2, 2), activation_fn=cn.ReLU)]))]
+
+results = []
+for name, build in variants:
+    report = build().profile(mini_batch_size, n_iter=50)
+    total = report[-1]
+    results.append((name, total['forward_flops'] / mini_batch_size,
+                    total['forward_s'], total['forward_s'] + total['backward_s']))
+
+base_train = results[0][3]
+print "\n{0:<26}{1:>14}{2:>12}{3:>16}{4:>10}".format(
+    "variant", "MFLOP/image", "fwd ms", "fwd+bwd ms", "speedup")
+for name, flops, t_forward, t_train in results:
+    print "{0:<26}{1:>14.2f}{2:>12.3f}{3:>16.3f}{4:>10.2f}".format(
+        name, flops / 1e6, 1e3*t_forward, 1e3*t_train, base_train / t_train)
@@ -0,0 +1,63 @@
+## Overhead of dropout per training step: the cost of drawing the
+## masks alone, with the former per-unit binomial draws and with the
+## uniform threshold of convnet.dropout_layer, and the training step of
+## the ConvNet of th_cnn_mnist.py with and without dropout
+
+## Libraries
+# Third-party libraries
+import numpy as np
+import theano
+import theano.tensor as T
+from theano.tensor import shared_randomstreams
+import convnet as cn
+import bench_utils as bu
+
+
+mini_batch_size = 64
+n_steps = 50
+floatX = theano.config.floatX
+
+# the dropout masks of the network below: the inputs of both dense layers
+shapes = [(mini_batch_size, 32*4*4), (mini_batch_size, 128)]
+
+def binomial_masks():
+    "Masks as drawn before, with one binomial stream per layer."
+    masks = []
+    for shape in shapes:
+        srng = shared_randomstreams.RandomStreams(
+            np.random.RandomState(0).randint(999999))
+        masks.append(T.cast(srng.binomial(n=1, p=0.5, size=shape), floatX))
+    return masks
+
+def uniform_masks():
+    "Masks as drawn by convnet.dropout_layer."
+    return [T.cast(cn.srng.uniform(size=shape, dtype=floatX) >= 0.5, floatX)
+            for shape in shapes]
+
+mask_times = []
+for name, masks in [('binomial', binomial_masks), ('uniform threshold', uniform_masks)]:
+    draw = theano.function([], [mask.sum() for mask in masks])
+    mask_times.append((name, np.median(cn.time_fn(draw, [], n_steps))))
+
+
+x, y = bu.synthetic_data(mini_batch_size)
+
+step_times = []
+for p_dropout in [0.0, 0.5]:
+    net = bu.build_net(p_dropout)
+    net.feedforward(mini_batch_size)
+    cost = net.layers[-1].cost(net)
+    train_mb = theano.function([], cost, givens={net.x: x, net.y: y},
+        updates=cn.optimizer_updates(cost, net.params, 'gd', 0.1))
+    infer_mb = theano.function([], net.layers[-1].y_out, givens={net.x: x})
+    step_times.append((p_dropout, np.median(cn.time_fn(train_mb, [], n_steps)),
+                       np.median(cn.time_fn(infer_mb, [], n_steps))))
+
+print "\nMasks of one training step, mini-batch size {0}".format(mini_batch_size)
+for name, t in mask_times:
+    print "  {0:<20}{1:>10.3f} ms".format(name, 1e3*t)
+print "{0:<12}{1:>14}{2:>14}".format("p_dropout", "train ms", "inference ms")
+for p_dropout, t_train, t_infer in step_times:
+    print "{0:<12}{1:>14.3f}{2:>14.3f}".format(p_dropout, 1e3*t_train, 1e3*t_infer)
+print "Dropout overhead per training step: {0:.3f} ms".format(
+    1e3*(step_times[1][1] - step_times[0][1]))
@@ -0,0 +1,33 @@
+## Throughput of a fused ensemble with test-time augmentation against
+## calling Network.predict once per model and per shifted view
+
+## Libraries
+# Third-party libraries
+import numpy as np
+import theano
+import convnet as cn
+import bench_utils as bu
+from time import time
+
+
+# throughput does not depend on the weights or pixel values
+nets = [bu.build_net() for _ in xrange(5)]
+shifts = [(0, 0), (1, 0), (-1, 0), (0, 1), (0, -1)]
+images = np.asarray(np.random.uniform(size=(5000, 784)), dtype=theano.config.floatX)
+ensemble = cn.Ensemble(nets, shifts)
+
+for mini_batch_size in [100, 500, 1000]:
+    ensemble.predict(images[:mini_batch_size], mini_batch_size) # compile
+    t0 = time()
+    ensemble.predict(images, mini_batch_size)
+    print "Fused, mini-batch {0}: {1:.0f} images/sec".format(
+        mini_batch_size, images.shape[0] / (time() - t0))
+
+# the same predictions, one model and one view at a time
+t0 = time()
+for net in nets:
+    for dy, dx in shifts:
+        view = np.roll(np.roll(images.reshape(-1, 28, 28), dy, axis=1), dx, axis=2)
+        net.predict(theano.shared(view.reshape(-1, 784)), 1000)
+print "Separate predict calls: {0:.0f} images/sec".format(
+    images.shape[0] / (time() - t0))
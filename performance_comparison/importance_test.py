@@ -0,0 +1,46 @@
+## Wall time to a target validation accuracy of the ConvNet of
+## th_cnn_mnist.py, trained on uniformly shuffled mini-batches and on
+## mini-batches importance-sampled by their loss
+
+## Libraries
+# Third-party libraries
+import pandas as pd
+import numpy as np
+import convnet as cn
+import bench_utils as bu
+
+
+## Read data from CSV file
+train = pd.read_csv("./convnet_MNIST/train.csv").values
+
+## Setting features and labels
+Xval, yval = train[35000:,1:], train[35000:,0]
+X, y = train[:35000,1:], train[:35000,0]
+Xval = Xval / 255.
+X = X / 255.
+del train
+
+target_accuracy = 0.99
+num_epochs = 15
+
+results = []
+for name, options in [('uniform shuffling', {}),
+                      ('importance sampling', {'sampling': 'importance'}),
+                      ('importance, rescored every 3 epochs',
+                       {'sampling': 'importance', 'score_every': 3})]:
+    # fresh copies: uniform shuffling reorders the training data in place
+    train_data, valid_data = cn.shared((X, y)), cn.shared((Xval, yval))
+    np.random.seed(0)
+    cn.set_seed(0)
+    net = bu.build_net()
+    net.fit(train_data, num_epochs, 16, 0.05, valid_data, lmbda=0.005,
+            optim_mode='adam', **options)
+    results.append((name, bu.time_to_target(net, target_accuracy), net.history[-1][1],
+                    net.scoring_time))
+
+print "\nSeconds to {0:.1%} validation accuracy".format(target_accuracy)
+print "{0:<40}{1:>12}{2:>12}{3:>12}".format("mini-batches", "to target", "total", "scoring")
+for name, to_target, total, scoring in results:
+    print "{0:<40}{1:>12}{2:>12.1f}{3:>12.1f}".format(
+        name, "never" if to_target is None else "{0:.1f}".format(to_target),
+        total, scoring)
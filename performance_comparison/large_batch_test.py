@@ -0,0 +1,44 @@
+## Final accuracy and training throughput of the ConvNet with small
+## mini-batches against large ones with warmup and LARS/LAMB
+
+## Libraries
+# Third-party libraries
+import pandas as pd
+import convnet as cn
+import bench_utils as bu
+
+
+## Read data from CSV file
+train = pd.read_csv("./convnet_MNIST/train.csv").values
+
+## Setting features and labels
+Xval, yval = train[20000:25000,1:], train[20000:25000,0]
+X, y = train[:20000,1:], train[:20000,0]
+Xval = Xval / 255.
+X = X / 255.
+del train
+
+train_data, valid_data = cn.shared((X, y)), cn.shared((Xval, yval))
+
+num_epochs = 15
+
+# (mini-batch size, optim_mode, eta, warmup epochs, decay)
+runs = [(32, 'adam', 0.05, 0, None),
+        (512, 'lars', 4.0, 2, 'cosine'),
+        (1024, 'lars', 8.0, 3, 'cosine'),
+        (1024, 'lamb', 0.01, 3, 'cosine'),
+        (4096, 'lamb', 0.02, 5, 'cosine')]
+
+results = []
+for mini_batch_size, optim_mode, eta, warmup_epochs, lr_decay in runs:
+    net = bu.build_net()
+    net.fit(train_data, num_epochs, mini_batch_size, eta, valid_data,
+            lmbda=0.005, optim_mode=optim_mode,
+            warmup_epochs=warmup_epochs, lr_decay=lr_decay)
+    epoch, elapsed, accuracy = net.history[-1]
+    trained = (cn.size(train_data) // mini_batch_size) * mini_batch_size * epoch
+    results.append((mini_batch_size, optim_mode, accuracy, trained / elapsed))
+
+print "\n{0:>8}{1:>8}{2:>16}{3:>16}".format("batch", "optim", "final val accu", "samples/sec")
+for mini_batch_size, optim_mode, accuracy, rate in results:
+    print "{0:>8}{1:>8}{2:>16.2%}{3:>16.0f}".format(mini_batch_size, optim_mode, accuracy, rate)
@@ -0,0 +1,107 @@
+## Micro-benchmarks of the forward pass, backward pass and update
+## (gd and Adam) of each layer type over a grid of shapes, on synthetic
+## data, with baselines stored per machine to catch regressions.
+##
+##   python layer_bench.py save <name>      runs the suite, stores baseline <name>
+##   python layer_bench.py compare <name>   runs the suite, compares with <name>
+
+## Libraries
+# Standard library
+import json
+import os
+import platform
+import sys
+
+# Third-party libraries
+import numpy as np
+import scipy.stats
+import theano
+import convnet as cn
+
+n_iter = 30
+p_value = 0.01     # significance level of a regression
+min_slowdown = 1.05  # ignore significant changes smaller than this
+baseline_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+
+def cases():
+    """Yield (name, layer factory, mini-batch size, optim_mode) for every
+    point of the grid."""
+    for mini_batch_size in [16, 64]:
+        for n_fmaps_in, n_fmaps_out, size in [(1, 16, 28), (16, 32, 12)]:
+            for k in [3, 5]:
+                name = 'ConvPoolLayer {0}x{1}x{2}x{2} on {3}x{3}'.format(
+                    n_fmaps_out, n_fmaps_in, k, size)
+                factory = lambda n_fmaps_in=n_fmaps_in, n_fmaps_out=n_fmaps_out, \
+                    size=size, k=k: cn.ConvPoolLayer(
+                        image_shape=(n_fmaps_in, size, size),
+                        filter_shape=(n_fmaps_out, n_fmaps_in, k, k),
+                        activation_fn=cn.ReLU)
+                yield name, factory, mini_batch_size, 'gd'
+        for n_in, n_out in [(512, 128), (128, 128), (1024, 1024)]:
+            name = 'FullyConnectedLayer {0}x{1}'.format(n_in, n_out)
+            factory = lambda n_in=n_in, n_out=n_out: cn.FullyConnectedLayer(
+                n_in=n_in, n_out=n_out, activation_fn=cn.ReLU, p_dropout=0.5)
+            yield name, factory, mini_batch_size, 'gd'
+            # the same layer updated by Adam
+            yield name, factory, mini_batch_size, 'adam'
+        factory = lambda: cn.SoftmaxLayer(n_in=128, n_out=10)
+        yield 'SoftmaxLayer 128x10', factory, mini_batch_size, 'gd'
+
+
+def run_suite():
+    "Return {case key: {phase: list of seconds}} for the whole grid."
+    results = {}
+    for name, factory, mini_batch_size, optim_mode in cases():
+        key = '{0}, batch {1}, {2}'.format(name, mini_batch_size, optim_mode)
+        print "Timing", key
+        results[key] = cn.time_layer(factory(), mini_batch_size, n_iter, optim_mode)
+    return results
+
+
+def machine():
+    "Identify the machine and software the timings belong to."
+    return {'node': platform.node(), 'processor': platform.processor(),
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'theano': theano.__version__, 'floatX': theano.config.floatX}
+
+
+if len(sys.argv) != 3 or sys.argv[1] not in ('save', 'compare'):
+    print "usage: python layer_bench.py save|compare <name>"
+    sys.exit(1)
+command, name = sys.argv[1:]
+filename = os.path.join(baseline_dir, platform.node(), name + '.json')
+
+if command == 'save':
+    results = run_suite()
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    with open(filename, 'w') as f:
+        json.dump({'machine': machine(), 'results': results}, f, indent=2)
+    print "Saved baseline", filename
+    sys.exit(0)
+
+with open(filename) as f:
+    baseline = json.load(f)
+if baseline['machine'] != machine():
+    print "Warning: the baseline was recorded with", baseline['machine']
+results = run_suite()
+regressions = 0
+print "\n{0:<60}{1:>10}{2:>12}{3:>12}{4:>10}".format(
+    "case", "phase", "base ms", "now ms", "p")
+for key in sorted(results):
+    if key not in baseline['results']:
+        continue
+    for phase in ['forward', 'backward', 'update']:
+        before, after = baseline['results'][key][phase], results[key][phase]
+        # Welch's t-test: the timings need not have equal variances
+        _, p = scipy.stats.ttest_ind(after, before, equal_var=False)
+        slowdown = np.median(after) / np.median(before)
+        flag = ''
+        if p < p_value and slowdown > min_slowdown:
+            flag = '  REGRESSION x{0:.2f}'.format(slowdown)
+            regressions += 1
+        print "{0:<60}{1:>10}{2:>12.3f}{3:>12.3f}{4:>10.4f}{5}".format(
+            key, phase, 1e3*np.median(before), 1e3*np.median(after), p, flag)
+print "\n{0} regression(s) against baseline {1}".format(regressions, name)
+sys.exit(1 if regressions else 0)
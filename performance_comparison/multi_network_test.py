@@ -0,0 +1,44 @@
+## Training throughput of K small networks of a learning rate sweep,
+## trained one after another with Network.fit and together in one
+## compiled step with MultiNetwork
+
+## Libraries
+# Third-party libraries
+import numpy as np
+import convnet as cn
+import bench_utils as bu
+
+
+mini_batch_size = 32
+
+def build_net():
+    return cn.Network([
+        cn.ConvPoolLayer(image_shape=(1, 28, 28),
+                      filter_shape=(8, 1, 5, 5),
+                      poolsize=(2, 2),
+                      activation_fn=cn.ReLU),
+        cn.FullyConnectedLayer(n_in=8*12*12, n_out=64,
+                      activation_fn=cn.ReLU, p_dropout=0.5),
+        cn.SoftmaxLayer(n_in=64, n_out=10)])
+
+train_data, valid_data = bu.synthetic_data(8192), bu.synthetic_data(1024)
+n_train = 8192
+
+results = []
+for K in [1, 4, 16]:
+    etas = np.logspace(-2, -0.5, K)
+    # one network at a time: the seconds each spent training
+    separate = 0.0
+    for eta in etas:
+        net = build_net()
+        net.fit(train_data, 1, mini_batch_size, eta, valid_data)
+        separate += net.history[-1][1]
+    multi = cn.MultiNetwork([build_net() for _ in xrange(K)])
+    multi.fit(train_data, 1, mini_batch_size, etas, valid_data)
+    fused = multi.history[-1][1]
+    results.append((K, K*n_train/separate, K*n_train/fused))
+
+print "\nExamples trained per second, summed over the K networks"
+print "{0:>4}{1:>16}{2:>16}{3:>10}".format("K", "separate", "MultiNetwork", "speedup")
+for K, separate, fused in results:
+    print "{0:>4}{1:>16.0f}{2:>16.0f}{3:>10.2f}".format(K, separate, fused, fused / separate)
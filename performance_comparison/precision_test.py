@@ -0,0 +1,42 @@
+## Speed, memory and accuracy of the ConvNet of th_test.py (experiment 5)
+## under each precision policy
+
+## Libraries
+# Third-party libraries
+import pandas as pd
+import convnet as cn
+import bench_utils as bu
+
+
+## Read data from CSV file
+train = pd.read_csv("./convnet_MNIST/train.csv").values
+
+## Setting features and labels
+Xval, yval = train[20000:25000,1:], train[20000:25000,0]
+X, y = train[:20000,1:], train[:20000,0]
+Xval = Xval / 255.
+X = X / 255.
+del train
+
+num_epochs = 5
+mini_batch_size = 32
+
+results = []
+for policy in ['float64', 'float32', 'float16']:
+    # the policy applies to the data and layers created after it is set
+    cn.set_precision(policy)
+    train_data, valid_data = cn.shared((X, y)), cn.shared((Xval, yval))
+    net = bu.build_net()
+    net.fit(train_data, num_epochs, mini_batch_size, 0.05, valid_data,
+            lmbda=0.005, optim_mode='adam')
+    epoch, elapsed, accuracy = net.history[-1]
+    data_bytes = sum([data[0].get_value(borrow=True).nbytes
+                      for data in [train_data, valid_data]])
+    model_bytes = net.memory_usage(mini_batch_size, training=True, optim_mode='adam')['total']
+    results.append((policy, elapsed / epoch, data_bytes, model_bytes, accuracy))
+
+print "\n{0:<10}{1:>12}{2:>12}{3:>14}{4:>12}".format(
+    "policy", "s/epoch", "data MB", "training MB", "val accu")
+for policy, epoch_time, data_bytes, model_bytes, accuracy in results:
+    print "{0:<10}{1:>12.1f}{2:>12.1f}{3:>14.1f}{4:>12.2%}".format(
+        policy, epoch_time, data_bytes / 2.**20, model_bytes / 2.**20, accuracy)
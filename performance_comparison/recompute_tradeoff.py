@@ -0,0 +1,93 @@
+## Training memory against step time when the conv and batch norm
+## layers of a deeper ConvNet recompute their activations in backprop.
+## Each configuration runs in a fresh process, whose peak resident
+## memory during the training steps, above what the weights, optimizer
+## state and data already hold, is measured (Linux only).  The static
+## estimate of the activations and gradients by Network.memory_usage is
+## shown next to it.
+##
+##   python recompute_tradeoff.py        runs every configuration
+##   python recompute_tradeoff.py 1      measures configuration 1
+
+## Libraries
+# Standard library
+import json
+import subprocess
+import sys
+
+
+mini_batch_size = 256
+n_steps = 20
+
+configs = [('none', ()),
+           ('conv layers', (0, 2, 4)),
+           ('conv and batch norm', (0, 1, 2, 3, 4))]
+
+
+def memory_status(field):
+    "Return the bytes of `field` (VmRSS, VmHWM) in /proc/self/status."
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) * 1024
+
+def measure(recompute):
+    """Return the estimated and measured memory of the training steps in
+    bytes, and the median step time in seconds, of the net recomputing
+    the layers `recompute`."""
+    import numpy as np
+    import theano
+    import convnet as cn
+    import bench_utils as bu
+    net = cn.Network([
+        cn.ConvPoolLayer(image_shape=(1, 28, 28),
+                      filter_shape=(32, 1, 5, 5),
+                      poolsize=(2, 2),
+                      activation_fn=cn.linear),
+        cn.BatchNormLayer((32, 12, 12), activation_fn=cn.ReLU),
+        cn.ConvPoolLayer(image_shape=(32, 12, 12),
+                      filter_shape=(64, 32, 3, 3),
+                      poolsize=(1, 1),
+                      activation_fn=cn.linear),
+        cn.BatchNormLayer((64, 10, 10), activation_fn=cn.ReLU),
+        cn.ConvPoolLayer(image_shape=(64, 10, 10),
+                      filter_shape=(64, 64, 3, 3),
+                      poolsize=(2, 2),
+                      activation_fn=cn.ReLU),
+        cn.FullyConnectedLayer(n_in=64*4*4, n_out=256,
+                      activation_fn=cn.ReLU, p_dropout=0.5),
+        cn.SoftmaxLayer(n_in=256, n_out=10)], recompute=recompute)
+    x, y = bu.synthetic_data(mini_batch_size)
+    usage = net.memory_usage(mini_batch_size, training=True, optim_mode='adam')
+    net.feedforward(mini_batch_size)
+    cost = net.layers[-1].cost(net)
+    updates = cn.optimizer_updates(cost, net.params, 'adam', 0.0)
+    updates += [update for layer in net.layers for update in getattr(layer, 'updates', [])]
+    train_mb = theano.function([], cost, updates=updates, givens={net.x: x, net.y: y})
+    # reset the peak to the current resident memory, which already holds
+    # the weights, optimizer state and data, then train
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    before = memory_status('VmRSS')
+    step = np.median(cn.time_fn(train_mb, [], n_steps))
+    return {'estimate': usage['activations'] + usage['gradients'],
+            'measured': memory_status('VmHWM') - before, 'step': step}
+
+
+if len(sys.argv) == 2:
+    print json.dumps(measure(configs[int(sys.argv[1])][1]))
+    sys.exit(0)
+
+results = []
+for j, (name, recompute) in enumerate(configs):
+    out = subprocess.check_output([sys.executable, __file__, str(j)])
+    results.append((name, json.loads(out.strip().splitlines()[-1])))
+
+base = results[0][1]
+print "\nMini-batch size {0}".format(mini_batch_size)
+print "{0:<24}{1:>14}{2:>14}{3:>10}{4:>12}{5:>10}".format(
+    "recomputed", "estimate MB", "measured MB", "x memory", "step ms", "x time")
+for name, r in results:
+    print "{0:<24}{1:>14.1f}{2:>14.1f}{3:>10.2f}{4:>12.1f}{5:>10.2f}".format(
+        name, r['estimate'] / 2.**20, r['measured'] / 2.**20,
+        r['measured'] / float(base['measured']), 1e3*r['step'], r['step'] / base['step'])
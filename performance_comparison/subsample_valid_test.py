@@ -0,0 +1,41 @@
+## Training time of the ConvNet of th_cnn_mnist.py with a large
+## validation set, scored in full every epoch and by a subsample that
+## escalates to the full set only when it may beat the best so far
+
+## Libraries
+# Third-party libraries
+import pandas as pd
+import numpy as np
+import convnet as cn
+import bench_utils as bu
+
+
+## Read data from CSV file
+train = pd.read_csv("./convnet_MNIST/train.csv").values
+
+## Setting features and labels: a validation set as large as the
+## training set, so that validation is a large share of the runtime
+Xval, yval = train[21000:,1:], train[21000:,0]
+X, y = train[:21000,1:], train[:21000,0]
+Xval = Xval / 255.
+X = X / 255.
+del train
+
+num_epochs = 15
+
+results = []
+for name, options in [('full validation', {}),
+                      ('subsample of 2000', {'valid_subsample': 2000})]:
+    train_data, valid_data = cn.shared((X, y)), cn.shared((Xval, yval))
+    np.random.seed(0)
+    cn.set_seed(0)
+    net = bu.build_net()
+    net.fit(train_data, num_epochs, 16, 0.05, valid_data, lmbda=0.005,
+            early_stop=True, optim_mode='adam', **options)
+    best = max([accuracy for epoch, elapsed, accuracy in net.history])
+    results.append((name, net.history[-1][1], net.eval_time_saved, best))
+
+print "\n{0:<24}{1:>12}{2:>12}{3:>16}".format(
+    "validation", "seconds", "saved", "best accuracy")
+for name, seconds, saved, best in results:
+    print "{0:<24}{1:>12.1f}{2:>12.1f}{3:>16.2%}".format(name, seconds, saved, best)
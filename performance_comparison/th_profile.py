@@ -0,0 +1,14 @@
+## Per-layer forward/backward/update profile of the ConvNet
+## of th_test.py (experiment 5)
+
+## Libraries
+import convnet as cn
+import bench_utils as bu
+
+
+mini_batch_size = 32
+net = bu.build_net()
+
+report = net.profile(mini_batch_size, n_iter=50, optim_mode='adam',
+                     json_file='th_profile.json')
+print cn.profile_table(report)
@@ -8,8 +8,6 @@ import six.moves.cPickle as pickle
 # Third-party libraries
 import pandas as pd
 import numpy as np
-import theano
-import theano.tensor as T
 import cnet as cn
 from time import time
 
@@ -24,18 +22,7 @@ Xval = Xval / 255.
 X = X / 255.
 del train
 
-def shared(data):
-    """Place the data into shared variables.  This allows Theano to copy
-       the data to the GPU, if one is available.
-
-    """
-    shared_x = theano.shared(
-      np.asarray(data[0], dtype=theano.config.floatX), borrow=True)
-    shared_y = theano.shared(
-      np.asarray(data[1], dtype='int32'), borrow=True)
-    return shared_x, shared_y
-
-train_data, valid_data = shared((X, y)), shared((Xval, yval))
+train_data, valid_data = cn.shared((X, y)), cn.shared((Xval, yval))
 del X, Xval, y, yval
 
 
@@ -0,0 +1,79 @@
+## Training and inference throughput of the ConvNet of th_test.py
+## against the number of intra-op threads and the mini-batch size,
+## to choose how many cores to give each of several jobs on a node.
+## Each measurement runs in a fresh process pinned by taskset (Linux).
+##
+##   python thread_scaling.py              runs the whole sweep
+##   python thread_scaling.py 4 32         measures 4 threads, batch 32
+
+## Libraries
+# Standard library
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+from time import time
+
+thread_counts = [1, 2, 4, 8, 16]
+batch_sizes = [16, 64, 256]
+n_steps = 50
+
+
+def measure(num_threads, mini_batch_size):
+    """Return the training and inference samples/sec of this process,
+    which its parent started pinned to the first `num_threads` cores."""
+    import theano
+    import convnet as cn
+    import bench_utils as bu
+    cn.set_threads(num_threads)
+    net = bu.build_net()
+    x, y = bu.synthetic_data(mini_batch_size)
+    net.feedforward(mini_batch_size)
+    cost = net.layers[-1].cost(net)
+    train_mb = theano.function([], cost, updates=cn.Adam(cost, net.params),
+                               givens={net.x: x, net.y: y})
+    predict_mb = theano.function([], net.layers[-1].y_out, givens={net.x: x})
+    rates = {}
+    for name, fn in [('train', train_mb), ('inference', predict_mb)]:
+        fn()
+        t0 = time()
+        for _ in xrange(n_steps):
+            fn()
+        rates[name] = n_steps * mini_batch_size / (time() - t0)
+    return rates
+
+
+if len(sys.argv) == 3:
+    num_threads, mini_batch_size = int(sys.argv[1]), int(sys.argv[2])
+    print json.dumps(measure(num_threads, mini_batch_size))
+    sys.exit(0)
+
+n_cores = multiprocessing.cpu_count()
+results = {}
+for num_threads in [n for n in thread_counts if n <= n_cores]:
+    for mini_batch_size in batch_sizes:
+        # a fresh process, so that BLAS and OpenMP read the thread count,
+        # pinned with all its threads by taskset before it starts any
+        env = dict(os.environ)
+        for var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+            env[var] = str(num_threads)
+        env['GOMP_CPU_AFFINITY'] = '0-{0}'.format(num_threads-1)
+        out = subprocess.check_output(
+            ['taskset', '-c', '0-{0}'.format(num_threads-1),
+             sys.executable, __file__, str(num_threads), str(mini_batch_size)], env=env)
+        results[num_threads, mini_batch_size] = json.loads(out.strip().splitlines()[-1])
+
+print "\n{0:>8}{1:>8}{2:>14}{3:>14}{4:>16}".format(
+    "threads", "batch", "train/s", "infer/s", "node train/s")
+for (num_threads, mini_batch_size), rates in sorted(results.items()):
+    # throughput of the whole node running n_cores/num_threads such jobs
+    node_rate = (n_cores // num_threads) * rates['train']
+    print "{0:>8}{1:>8}{2:>14.0f}{3:>14.0f}{4:>16.0f}".format(
+        num_threads, mini_batch_size, rates['train'], rates['inference'], node_rate)
+
+for mini_batch_size in batch_sizes:
+    best = max([n for n, b in results if b == mini_batch_size],
+               key=lambda n: (n_cores // n) * results[n, mini_batch_size]['train'])
+    print "Batch {0}: best training throughput per node with {1} cores per job".format(
+        mini_batch_size, best)
@@ -107,21 +107,57 @@ def feedforward(data, weights, biases, drop_param):
     logits = tf.matmul(hidden, weights['output']) + biases['output']
     return logits
 
+## Input pipeline
+# The training set is copied once into a non-trainable variable, and
+# background threads slice it in a freshly shuffled order every epoch
+# and queue up mini-batches, so the training step needs no feed_dict.
+train_x, train_y = train_x.astype(np.float32), train_y.astype(np.float32)
+data_x_init = tf.placeholder(tf.float32, train_x.shape)
+data_y_init = tf.placeholder(tf.float32, train_y.shape)
+data_x = tf.Variable(data_x_init, trainable=False, collections=[])
+data_y = tf.Variable(data_y_init, trainable=False, collections=[])
+example_x, example_y = tf.train.slice_input_producer([data_x, data_y], shuffle=True)
+batch_x, batch_y = tf.train.batch([example_x, example_y], batch_size,
+                                  num_threads=2, capacity=20*batch_size)
+
 ## Define placeholders
-x = tf.placeholder(tf.float32, [None, image_size, image_size, num_channels])
-y = tf.placeholder(tf.float32, [None, label_units])
-drop_param = tf.placeholder(tf.float32, [3,])
+# They read from the input queue unless fed, as in evaluation
+x = tf.placeholder_with_default(batch_x, [None, image_size, image_size, num_channels])
+y = tf.placeholder_with_default(batch_y, [None, label_units])
+drop_param = tf.placeholder_with_default(tf.constant(drop_ratio), [3,])
 
 ## Construct tensor flow
 logits = feedforward(x, weights, biases, drop_param)
 l2_norm_squared = sum([tf.nn.l2_loss(weights[layer]) for layer in weights])
-cost = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(logits, y)) + \
-        tf.div(lmbda*l2_norm_squared, tf.to_float(tf.shape(x)[0]))
+xent = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(logits, y))
+cost = xent + tf.div(lmbda*l2_norm_squared, tf.to_float(tf.shape(x)[0]))
 optimizer = tf.train.AdamOptimizer(learning_rate=0.001).minimize(cost)
 #optimizer = tf.train.GradientDescentOptimizer(learning_rate=learning_rate).minimize(cost)
 pred = tf.argmax(tf.nn.softmax(logits), 1)
 accu = tf.reduce_mean(tf.cast( tf.equal(pred, tf.argmax(y, 1)), tf.float32 ))
 
+def evaluate(sess, data_x, data_y, eval_batch_size=1000):
+    """Return the cost and accuracy of the net on the whole of (data_x,
+    data_y), fed eval_batch_size examples at a time to bound memory"""
+    num_samples = data_x.shape[0]
+    total_xent, total_accu = 0., 0.
+    for offset in xrange(0, num_samples, eval_batch_size):
+        feed = {x: data_x[offset:(offset+eval_batch_size)],
+                y: data_y[offset:(offset+eval_batch_size)],
+                drop_param: [1, 1, 1]}
+        c, a = sess.run([xent, accu], feed_dict=feed)
+        n = feed[x].shape[0]
+        total_xent += c * n
+        total_accu += a * n
+    l2_cost = lmbda * sess.run(l2_norm_squared) / num_samples
+    return total_xent / num_samples + l2_cost, total_accu / num_samples
+
+def predict(sess, data_x, eval_batch_size=1000):
+    """Return the predicted labels of data_x, a batch at a time"""
+    return np.concatenate([
+        pred.eval({x: data_x[offset:(offset+eval_batch_size)], drop_param: [1, 1, 1]})
+        for offset in xrange(0, data_x.shape[0], eval_batch_size)])
+
 ## Start training!
 epochs = 20
 num_batches = train_x.shape[0]/batch_size
@@ -134,58 +170,56 @@ with tf.Session() as sess:
     """
     for each epoch, do:
         for each batch, do:
-            create pre-processed batch
-            run optimizer by feeding batch
+            dequeue pre-processed batch
+            run optimizer on batch
             find cost and reiterate to minimize
     """
     sess.run(init)
+    sess.run([data_x.initializer, data_y.initializer],
+             feed_dict={data_x_init: train_x, data_y_init: train_y})
+    coord = tf.train.Coordinator()
+    threads = tf.train.start_queue_runners(sess=sess, coord=coord)
     print('Initialized. Start training...')
     t0 = time()
     for epoch in xrange(epochs):
         avg_cost = 0
-        for step in xrange(num_batches):
-            #batch_mask = np.random.choice(np.arange(train_x.shape[0]), batch_size, replace=False)
-            #batch_x, batch_y = train_x[[batch_mask]], train_y[[batch_mask]]
-            offset = step * batch_size
-            batch_x, batch_y = train_x[offset:(offset+batch_size), :], train_y[offset:(offset+batch_size), :]
-            _, c = sess.run([optimizer, cost], feed_dict={x: batch_x, y: batch_y, drop_param: drop_ratio})
+        for step in xrange(num_batches-1):
+            _, c = sess.run([optimizer, cost])
             avg_cost += (c / num_batches)
+        # keep the last mini-batch of the epoch to report its accuracy
+        _, c, last_x, last_y = sess.run([optimizer, cost, batch_x, batch_y])
+        avg_cost += (c / num_batches)
 
         print "Epoch:", (epoch+1), "\n  avg minibatch cost = {:.5f}".format(avg_cost)
-        batch_accu = accu.eval({x: batch_x, y: batch_y, drop_param: [1, 1, 1]})
+        batch_accu = accu.eval({x: last_x, y: last_y, drop_param: [1, 1, 1]})
         print "  minibatch accuracy: {:.2%}".format(batch_accu)
-        val_cost = cost.eval({x: val_x, y: val_y, drop_param: [1, 1, 1]})
+        val_cost, val_accu = evaluate(sess, val_x, val_y)
         print "  validation cost = {:.5f}".format(val_cost)
-        val_accu = accu.eval({x: val_x, y: val_y, drop_param: [1, 1, 1]})
         print "  validation accuracy: {:.2%}".format(val_accu)
         if val_cost <= best_val_cost:
             best_val_cost = val_cost
             print "This is the best model to date."
             saver.save(sess, 'best_model.ckpt')
 
-        # shuffle the data
-        order = np.arange(train_x.shape[0])
-        np.random.shuffle(order)
-        train_x = train_x[order]
-        train_y = train_y[order]
-
     print "\nTraining complete!"
     print "\nElapsed time:", time()-t0
+    coord.request_stop()
+    coord.join(threads)
+
 
-    
 # Create a restorer
 print "Predicting and saving to a submission file..."
 with tf.Session() as sess:
     saver.restore(sess, 'best_model.ckpt')
 
     # find predictions on val set
-    print "Training accuracy: {:.2%}".format(accu.eval({x: train_x, y: train_y, drop_param: [1, 1, 1]}))
-    print "Validation accuracy: {:.2%}".format(accu.eval({x: val_x, y: val_y, drop_param: [1, 1, 1]}))
+    print "Training accuracy: {:.2%}".format(evaluate(sess, train_x, train_y)[1])
+    print "Validation accuracy: {:.2%}".format(evaluate(sess, val_x, val_y)[1])
 
     test = pd.read_csv("./convnet_MNIST/test.csv").values
     test = test / 255.
     test = test.reshape(-1, image_size, image_size, num_channels)
-    pred_test = pred.eval({x: test, drop_param: [1, 1, 1]})
+    pred_test = predict(sess, test)
 
 # export Kaggle submission file
 fh = open('eval.txt','w+')
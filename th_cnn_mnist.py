@@ -17,18 +17,6 @@ from time import time
 # Global Contrast Normalization
 def norm_input(x): return (x-mean_px)/std_px
 
-# Transform data to theano's format
-def shared(data):
-    """Place the data into shared variables.  This allows Theano to copy
-       the data to the GPU, if one is available.
-    """
-    shared_x = theano.shared(
-      np.asarray(data[0], dtype=theano.config.floatX), borrow=True)
-    shared_y = theano.shared(
-      np.asarray(data[1], dtype='int32'), borrow=True)
-    return shared_x, shared_y
-
-
 ## Load data from CSV file 
 train = pd.read_csv("./convnet_theano/train.csv").values
 
@@ -40,7 +28,8 @@ Xval, yval = train[:6320], train_label[:6320]
 X, y = train[6320:], train[6320:]
 del train, train_label
 
-train_data, valid_data = shared((X, y)), shared((Xval, yval))
+# Transform data to theano's format, in the precision policy's storage dtype
+train_data, valid_data = cn.shared((X, y)), cn.shared((Xval, yval))
 del X, Xval
 
 
@@ -108,7 +97,7 @@ print "Training accuracy:", valid_acc
 test = pd.read_csv("./convnet_theano/test.csv").values
 test = norm_input(test)
 test_data = theano.shared(np.asarray(test, 
-    dtype=theano.config.floatX), borrow=True)
+    dtype=cn.STORAGE_DTYPE), borrow=True)
 net = pickle.load(open('./best_model.pkl'))
 print "\nEvaluating..."
 t1 = time()